@@ -7,7 +7,7 @@ set -e
 # 配置变量
 FUNCTION_NAME="update-resolver-rule"
 RUNTIME="python3.9"
-TIMEOUT=60
+TIMEOUT=900
 MEMORY_SIZE=128
 DEPLOYMENT_DIR="lambda-deployment"
 
@@ -4,13 +4,23 @@
 """
 
 import json
-from update_resolver_rule import update_resolver_rule_target_ips, lambda_handler
+from update_resolver_rule import (
+    apply_target_ip_profile,
+    get_target_ip_profile,
+    lambda_handler,
+    update_resolver_rule_target_ips,
+)
 
 # 配置参数
 RESOLVER_RULE_ID = "rslvr-rr-4434e3b2252648c2a"
-TARGET_IPS = ['8.8.8.8', '8.8.4.6']
+TARGET_IP_PROFILE = "public-fallback"
+TARGET_IPS = [target['Ip'] for target in get_target_ip_profile(TARGET_IP_PROFILE)]
 REGION = "us-west-2"
 
+# 按profile批量切换时匹配的规则标签
+TAG_KEY = "dns-failover"
+TAG_VALUE = "enabled"
+
 def demo_direct_call():
     """
     直接调用核心函数
@@ -70,6 +80,30 @@ def demo_lambda_handler():
         import traceback
         traceback.print_exc()
 
+def demo_apply_profile():
+    """
+    将profile应用到所有带指定标签的forward规则
+    """
+    print("=" * 60)
+    print("按Profile批量切换Demo")
+    print("=" * 60)
+    
+    print(f"Profile: {TARGET_IP_PROFILE} -> {TARGET_IPS}")
+    print(f"Tag: {TAG_KEY}={TAG_VALUE}")
+    print(f"Region: {REGION}")
+    print("-" * 40)
+    
+    try:
+        result = apply_target_ip_profile(TARGET_IP_PROFILE, TAG_KEY, TAG_VALUE, REGION)
+        print(f"✅ 匹配 {result['matched']} 条规则: 更新 {result['updated']}, "
+              f"跳过 {result['skipped']}, 失败 {result['failed']}")
+        print(f"结果: {json.dumps(result, indent=2, default=str)}")
+        
+    except Exception as e:
+        print(f"❌ 批量切换失败: {str(e)}")
+        import traceback
+        traceback.print_exc()
+
 def main():
     """
     主函数
@@ -78,8 +112,9 @@ def main():
     print("1) 直接调用核心函数")
     print("2) 模拟Lambda处理函数调用")
     print("3) 两种方式都执行")
+    print("4) 按Profile批量切换带标签的规则")
     
-    choice = input("请选择 (1, 2, 或 3，默认为3): ").strip() or "3"
+    choice = input("请选择 (1, 2, 3 或 4，默认为3): ").strip() or "3"
     
     if choice == "1":
         demo_direct_call()
@@ -89,6 +124,8 @@ def main():
         demo_direct_call()
         print("\n" + "=" * 60 + "\n")
         demo_lambda_handler()
+    elif choice == "4":
+        demo_apply_profile()
     else:
         print("无效选择")
 
@@ -1,29 +1,172 @@
 import boto3
+import os
+import base64
+import hashlib
+import zlib
 import json
 import logging
-from typing import List, Dict, Any
-from botocore.exceptions import ClientError
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
+from botocore.exceptions import BotoCoreError, ClientError
+from botocore.config import Config
 
 # 配置日志
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# 剩余执行时间低于该值（毫秒）时保存进度并返回continuation_token
+CHECKPOINT_MARGIN_MS = int(os.environ.get('CHECKPOINT_MARGIN_MS', '15000'))
+
+# continuation_token格式版本
+CHECKPOINT_VERSION = 1
+
+# 跨账户操作时在规则所属账户中扮演的角色名称
+CROSS_ACCOUNT_ROLE_NAME = os.environ.get('CROSS_ACCOUNT_ROLE_NAME', 'Route53ResolverManagerRole')
+
+# 多账户并发处理时的最大线程数
+MAX_ACCOUNT_WORKERS = int(os.environ.get('MAX_ACCOUNT_WORKERS', '8'))
+
+# 按profile批量更新规则时的最大并发数，同时作为客户端连接池大小
+MAX_UPDATE_WORKERS = int(os.environ.get('MAX_UPDATE_WORKERS', '32'))
+
+# 等待规则更新完成时的轮询间隔（秒）和超时时间（秒）
+RULE_POLL_INTERVAL = float(os.environ.get('RULE_POLL_INTERVAL', '5'))
+RULE_UPDATE_TIMEOUT = float(os.environ.get('RULE_UPDATE_TIMEOUT', '300'))
+
+# 性能分析：PROFILE_INVOCATIONS=1时对每次调用启用cProfile和tracemalloc，
+# 也可以在event中传入"debug_profile": true只分析单次调用
+PROFILE_INVOCATIONS = os.environ.get('PROFILE_INVOCATIONS', '').lower() in ('1', 'true', 'yes')
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', '15'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp')
+
+# 幂等键结果的缓存时间（秒）
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '3600'))
+# 执行中占用幂等键的最长时间，超过后视为执行已中断，允许重试（不小于Lambda超时时间）
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '900'))
+
+# 内置的目标IP profile，可通过环境变量TARGET_IP_PROFILES（JSON）覆盖或新增，例如
+# {"infoblox": ["10.0.0.10", "10.0.1.10"], "public-fallback": [{"Ip": "8.8.8.8", "Port": 53}]}
+DEFAULT_TARGET_IP_PROFILES = {
+    'public-fallback': ['8.8.8.8', '8.8.4.4']
+}
+
+# 已校验并构建好的profile配置，按名称缓存
+_TARGET_IP_PROFILE_CONFIGS: Dict[str, List[Dict[str, Any]]] = {}
+
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Lambda函数入口点
     
     Args:
-        event: Lambda事件，包含resolver_rule_id、target_ips和region
+        event: Lambda事件，包含resolver_rule_id、target_ips、region和可选的account_id；
+            批量更新时包含updates列表（或续跑用的continuation_token）；
+            按profile更新时包含target_ip_profile、tag_key和可选的tag_value；
+            分波次金丝雀更新时包含rollout配置；
+            SQS批量消息时包含Records（每条消息body为单次更新或EventBridge事件）；
+            以上格式都可以带idempotency_key，重复的请求直接返回第一次成功的结果；
+            带debug_profile: true（或设置环境变量PROFILE_INVOCATIONS=1）时对本次调用进行性能分析
+        context: Lambda上下文
+    
+    Returns:
+        响应字典，包含状态码和消息；SQS批量消息时返回batchItemFailures
+    """
+    if PROFILE_INVOCATIONS or event.get('debug_profile'):
+        return _run_profiled(_process_event, event, context)
+    return _process_event(event, context)
+
+def _process_event(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    按event类型分发处理
+    
+    Args:
+        event: Lambda事件
+        context: Lambda上下文
+    
+    Returns:
+        响应字典
+    """
+    if 'Records' in event:
+        return process_records(event, context)
+    
+    # EventBridge直接触发时更新参数放在detail中
+    if 'detail-type' in event and isinstance(event.get('detail'), dict):
+        event = event['detail']
+    
+    idempotency_key = event.get('idempotency_key')
+    if idempotency_key:
+        fingerprint = _request_fingerprint(event)
+        try:
+            cached = IDEMPOTENCY_CACHE.get(idempotency_key, fingerprint)
+        except ValueError as e:
+            logger.error(str(e))
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': str(e)
+                })
+            }
+        if cached is not None:
+            logger.info(f"Idempotency key {idempotency_key} already processed, returning stored response")
+            return cached
+        
+        # 先占用幂等键，同一请求的并发重试不会同时执行
+        if not IDEMPOTENCY_CACHE.acquire(idempotency_key, fingerprint):
+            cached = IDEMPOTENCY_CACHE.get(idempotency_key, fingerprint)
+            if cached is not None:
+                return cached
+            logger.warning(f"Idempotency key {idempotency_key} is already being processed")
+            return {
+                'statusCode': 409,
+                'body': json.dumps({
+                    'error': f'Request with idempotency key {idempotency_key} is in progress, retry later'
+                })
+            }
+    
+    try:
+        response = _handle_event(event, context)
+    except Exception:
+        if idempotency_key:
+            IDEMPOTENCY_CACHE.release(idempotency_key)
+        raise
+    
+    # 只缓存最终成功的结果，失败和未完成（202）的请求释放幂等键，允许重试
+    if idempotency_key:
+        if response['statusCode'] == 200:
+            IDEMPOTENCY_CACHE.put(idempotency_key, response, fingerprint)
+        else:
+            IDEMPOTENCY_CACHE.release(idempotency_key)
+    return response
+
+def _handle_event(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    处理单个（非SQS）事件
+    
+    Args:
+        event: Lambda事件
         context: Lambda上下文
     
     Returns:
         响应字典，包含状态码和消息
     """
     try:
+        if 'updates' in event or 'continuation_token' in event:
+            return run_batch_updates(event, context)
+        
+        if 'rollout' in event:
+            return _rollout_response(event, context)
+        
+        if 'target_ip_profile' in event:
+            return _profile_response(event)
+        
         # 解析输入参数
         resolver_rule_id = event.get('resolver_rule_id')
         target_ips = event.get('target_ips', [])
         region = event.get('region')
+        account_id = event.get('account_id')
         
         if not resolver_rule_id:
             return {
@@ -41,19 +184,18 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 })
             }
         
+        if account_id is not None and not _is_valid_account_id(account_id):
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': f'Invalid account_id: {account_id}'
+                })
+            }
+        
         # 调用更新函数
-        result = update_resolver_rule_target_ips(resolver_rule_id, target_ips, region)
+        result = update_resolver_rule_target_ips(resolver_rule_id, target_ips, region, account_id=account_id)
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'message': 'Resolver rule updated successfully',
-                'resolver_rule_id': resolver_rule_id,
-                'region': region or 'default',
-                'updated_target_ips': target_ips,
-                'result': result
-            })
-        }
+        return _update_response(resolver_rule_id, region, target_ips, result)
         
     except Exception as e:
         logger.error(f"Error updating resolver rule: {str(e)}")
@@ -64,7 +206,26 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             })
         }
 
-def update_resolver_rule_target_ips(resolver_rule_id: str, target_ips: List[str], region: str = None) -> Dict[str, Any]:
+def _update_response(resolver_rule_id: str, region: Optional[str], target_ips: List[Any],
+                     result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    单条规则更新成功时的响应，直接调用和SQS消息使用相同的格式保存到幂等缓存
+    """
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Resolver rule updated successfully',
+            'resolver_rule_id': resolver_rule_id,
+            'region': region or 'default',
+            'updated_target_ips': target_ips,
+            'result': result
+        })
+    }
+
+def update_resolver_rule_target_ips(resolver_rule_id: str, target_ips: List[str], region: str = None,
+                                    current_rule: Optional[Dict[str, Any]] = None,
+                                    account_id: Optional[str] = None,
+                                    target_ips_config: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
     """
     更新Route53 Resolver Rule的目标IP地址
     
@@ -72,6 +233,9 @@ def update_resolver_rule_target_ips(resolver_rule_id: str, target_ips: List[str]
         resolver_rule_id: Resolver Rule的ID
         target_ips: 新的目标IP地址列表
         region: AWS区域名称，如果未指定则使用默认区域
+        current_rule: 已查询到的当前规则信息，提供时跳过get_resolver_rule调用
+        account_id: 规则所属账户，指定时扮演该账户中的角色执行更新
+        target_ips_config: 预先构建并校验过的TargetIps配置（如profile），提供时直接提交
     
     Returns:
         更新操作的结果
@@ -81,47 +245,31 @@ def update_resolver_rule_target_ips(resolver_rule_id: str, target_ips: List[str]
         ValueError: 输入参数无效
     """
     # 验证IP地址格式
-    for ip in target_ips:
-        if not _is_valid_ip(ip):
-            raise ValueError(f"Invalid IP address format: {ip}")
+    if target_ips_config is None:
+        target_ips_config = _build_target_ips_config(target_ips)
     
     # 验证region格式（如果提供）
     if region and not _is_valid_region(region):
         raise ValueError(f"Invalid AWS region format: {region}")
     
-    # 创建Route53 Resolver客户端，指定区域
-    client_kwargs = {}
-    if region:
-        client_kwargs['region_name'] = region
-        logger.info(f"Using specified region: {region}")
-    else:
-        logger.info("Using default region from AWS configuration")
-    
-    route53resolver = boto3.client('route53resolver', **client_kwargs)
+    route53resolver = _get_resolver_client(region, account_id)
     
     try:
         # 首先获取当前的resolver rule信息
-        logger.info(f"Getting current resolver rule info for ID: {resolver_rule_id}")
-        response = route53resolver.get_resolver_rule(ResolverRuleId=resolver_rule_id)
-        current_rule = response['ResolverRule']
+        if current_rule is None:
+            logger.info(f"Getting current resolver rule info for ID: {resolver_rule_id}")
+            response = route53resolver.get_resolver_rule(ResolverRuleId=resolver_rule_id)
+            current_rule = response['ResolverRule']
         
         logger.info(f"Current rule status: {current_rule['Status']}")
         logger.info(f"Current target IPs: {[target['Ip'] for target in current_rule.get('TargetIps', [])]}")
         
-        # 构建新的目标IP配置
-        new_target_ips = []
-        for ip in target_ips:
-            new_target_ips.append({
-                'Ip': ip,
-                'Port': 53  # DNS默认端口
-            })
-        
         # 更新resolver rule
         logger.info(f"Updating resolver rule {resolver_rule_id} with new target IPs: {target_ips}")
         update_response = route53resolver.update_resolver_rule(
             ResolverRuleId=resolver_rule_id,
             Config={
-                'TargetIps': new_target_ips
+                'TargetIps': target_ips_config
             }
         )
         
@@ -160,6 +308,285 @@ def update_resolver_rule_target_ips(resolver_rule_id: str, target_ips: List[str]
         logger.error(f"Unexpected error: {str(e)}")
         raise
 
+class AssumedRoleCredentialCache:
+    """
+    按账户缓存AssumeRole得到的临时凭证
+    
+    凭证在距离过期不足refresh_margin_seconds前一直复用；进入background_refresh_seconds
+    窗口后仍返回缓存凭证，同时在后台线程中提前刷新，避免请求路径上等待STS。
+    sts_client可以替换为本地的STS替身（只需实现assume_role），便于离线测试。
+    """
+    
+    def __init__(self, sts_client: Any = None, role_name: str = CROSS_ACCOUNT_ROLE_NAME,
+                 session_name: str = 'route53-resolver-rule-updater', duration_seconds: int = 3600,
+                 refresh_margin_seconds: int = 300, background_refresh_seconds: int = 900,
+                 clock: Any = time.time):
+        self._sts_client = sts_client
+        self._role_name = role_name
+        self._session_name = session_name
+        self._duration_seconds = duration_seconds
+        self._refresh_margin_seconds = refresh_margin_seconds
+        self._background_refresh_seconds = background_refresh_seconds
+        self._clock = clock
+        
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._account_locks: Dict[str, threading.Lock] = {}
+        self._refreshing = set()
+        self._executor: Optional[ThreadPoolExecutor] = None
+    
+    def get_credentials(self, account_id: str) -> Dict[str, Any]:
+        """
+        获取账户的临时凭证
+        
+        Args:
+            account_id: 目标账户ID
+        
+        Returns:
+            包含access_key_id、secret_access_key、session_token和expiration（时间戳）的字典
+        
+        Raises:
+            ClientError: AssumeRole调用失败
+        """
+        with self._lock:
+            entry = self._entries.get(account_id)
+        
+        if entry is not None:
+            remaining = entry['expiration'] - self._clock()
+            if remaining > self._refresh_margin_seconds:
+                if remaining <= self._background_refresh_seconds:
+                    self._schedule_refresh(account_id)
+                return entry
+        
+        # 缓存缺失或即将过期，同步获取；同一账户同一时间只有一个线程调用STS
+        with self._account_lock(account_id):
+            with self._lock:
+                entry = self._entries.get(account_id)
+            if entry is not None and entry['expiration'] - self._clock() > self._refresh_margin_seconds:
+                return entry
+            return self._assume_role(account_id)
+    
+    def invalidate(self, account_id: Optional[str] = None) -> None:
+        """
+        清除指定账户（或全部账户）的缓存凭证
+        
+        Args:
+            account_id: 目标账户ID，为None时清除全部
+        """
+        with self._lock:
+            if account_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(account_id, None)
+    
+    def _account_lock(self, account_id: str) -> threading.Lock:
+        with self._lock:
+            return self._account_locks.setdefault(account_id, threading.Lock())
+    
+    def _get_sts_client(self) -> Any:
+        if self._sts_client is None:
+            # STS_ENDPOINT_URL可指向本地STS替身
+            self._sts_client = boto3.client('sts', endpoint_url=os.environ.get('STS_ENDPOINT_URL'))
+        return self._sts_client
+    
+    def _assume_role(self, account_id: str) -> Dict[str, Any]:
+        role_arn = f"arn:aws:iam::{account_id}:role/{self._role_name}"
+        logger.info(f"Assuming role: {role_arn}")
+        
+        response = self._get_sts_client().assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=self._session_name,
+            DurationSeconds=self._duration_seconds
+        )
+        credentials = response['Credentials']
+        expiration = credentials['Expiration']
+        
+        entry = {
+            'access_key_id': credentials['AccessKeyId'],
+            'secret_access_key': credentials['SecretAccessKey'],
+            'session_token': credentials['SessionToken'],
+            # boto3返回datetime，STS替身也可以直接返回时间戳
+            'expiration': expiration.timestamp() if hasattr(expiration, 'timestamp') else float(expiration)
+        }
+        with self._lock:
+            self._entries[account_id] = entry
+        return entry
+    
+    def _schedule_refresh(self, account_id: str) -> None:
+        with self._lock:
+            if account_id in self._refreshing:
+                return
+            self._refreshing.add(account_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='credential-refresh')
+        self._executor.submit(self._background_refresh, account_id)
+    
+    def _background_refresh(self, account_id: str) -> None:
+        try:
+            with self._account_lock(account_id):
+                self._assume_role(account_id)
+        except Exception as e:
+            # 后台刷新失败不影响当前凭证，到期前的同步路径会再次尝试
+            logger.warning(f"Background credential refresh failed for account {account_id}: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(account_id)
+
+# 容器生命周期内共享的凭证缓存，测试时可替换为使用STS替身的实例
+CREDENTIAL_CACHE = AssumedRoleCredentialCache()
+
+_client_lock = threading.Lock()
+_resolver_clients: Dict[Any, Any] = {}
+
+def _get_resolver_client(region: Optional[str] = None, account_id: Optional[str] = None) -> Any:
+    """
+    获取Route53 Resolver客户端，按(account_id, region)在容器生命周期内复用，凭证刷新后自动重建
+    
+    Args:
+        region: AWS区域名称，如果未指定则使用默认区域
+        account_id: 目标账户ID，如果未指定则使用Lambda自身凭证
+    
+    Returns:
+        Route53 Resolver客户端
+    
+    Raises:
+        ClientError: 扮演目标账户角色失败
+    """
+    credentials = CREDENTIAL_CACHE.get_credentials(account_id) if account_id else None
+    expiration = credentials['expiration'] if credentials else None
+    key = (account_id, region)
+    
+    with _client_lock:
+        cached = _resolver_clients.get(key)
+        if cached is not None and cached[0] == expiration:
+            return cached[1]
+        
+        # 创建Route53 Resolver客户端，指定区域
+        client_kwargs = {}
+        if region:
+            client_kwargs['region_name'] = region
+            logger.info(f"Using specified region: {region}")
+        else:
+            logger.info("Using default region from AWS configuration")
+        
+        if credentials:
+            logger.info(f"Using assumed role credentials for account: {account_id}")
+            session = boto3.Session(
+                aws_access_key_id=credentials['access_key_id'],
+                aws_secret_access_key=credentials['secret_access_key'],
+                aws_session_token=credentials['session_token']
+            )
+        else:
+            session = boto3.Session()
+        
+        # 连接池与并发更新数一致，避免并发请求排队等待连接
+        route53resolver = session.client('route53resolver',
+                                         config=Config(max_pool_connections=MAX_UPDATE_WORKERS),
+                                         **client_kwargs)
+        _resolver_clients[key] = (expiration, route53resolver)
+        return route53resolver
+
+def _is_valid_account_id(account_id: Any) -> bool:
+    """
+    验证AWS账户ID格式是否有效
+    
+    Args:
+        account_id: 账户ID
+    
+    Returns:
+        True如果是12位数字，否则False
+    """
+    return isinstance(account_id, str) and bool(re.match(r'^\d{12}$', account_id))
+
+def _build_target_ips_config(target_ips: List[Any]) -> List[Dict[str, Any]]:
+    """
+    构建TargetIps配置
+    
+    Args:
+        target_ips: IP地址字符串（使用53端口）或{"Ip": ..., "Port": ...}字典的列表
+    
+    Returns:
+        可直接传给update_resolver_rule的TargetIps列表
+    
+    Raises:
+        ValueError: IP地址或端口无效
+    """
+    config = []
+    for target in target_ips:
+        if isinstance(target, dict):
+            ip = target.get('Ip')
+            port = target.get('Port', 53)
+        else:
+            ip = target
+            port = 53  # DNS默认端口
+        
+        if not isinstance(ip, str) or not _is_valid_ip(ip):
+            raise ValueError(f"Invalid IP address format: {ip}")
+        if not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError(f"Invalid port for {ip}: {port}")
+        
+        config.append({
+            'Ip': ip,
+            'Port': port
+        })
+    return config
+
+def get_target_ip_profile(profile_name: str) -> List[Dict[str, Any]]:
+    """
+    获取目标IP profile对应的TargetIps配置
+    
+    profile在第一次使用时才解析和校验，构建结果在容器内缓存；某个profile配置错误
+    只影响使用该profile的请求，不影响函数初始化和其他请求
+    
+    Args:
+        profile_name: 内置或TARGET_IP_PROFILES中配置的profile名称
+    
+    Returns:
+        可直接传给update_resolver_rule的TargetIps列表
+    
+    Raises:
+        ValueError: profile不存在、TARGET_IP_PROFILES格式无效或profile中的IP无效
+    """
+    target_ips_config = _TARGET_IP_PROFILE_CONFIGS.get(profile_name)
+    if target_ips_config is not None:
+        return target_ips_config
+    
+    profiles = _load_target_ip_profiles()
+    target_ips = profiles.get(profile_name)
+    if target_ips is None:
+        raise ValueError(f"Unknown target IP profile: {profile_name}")
+    if not isinstance(target_ips, list) or not target_ips:
+        raise ValueError(f"Target IP profile {profile_name} must be a non-empty list")
+    try:
+        target_ips_config = _build_target_ips_config(target_ips)
+    except ValueError as e:
+        raise ValueError(f"Invalid target IP profile {profile_name}: {str(e)}")
+    
+    _TARGET_IP_PROFILE_CONFIGS[profile_name] = target_ips_config
+    return target_ips_config
+
+def _load_target_ip_profiles() -> Dict[str, Any]:
+    """
+    合并内置profile和TARGET_IP_PROFILES环境变量，不校验各profile的内容
+    
+    Returns:
+        profile名称到目标IP列表的映射
+    
+    Raises:
+        ValueError: TARGET_IP_PROFILES环境变量格式无效
+    """
+    profiles = dict(DEFAULT_TARGET_IP_PROFILES)
+    overrides = os.environ.get('TARGET_IP_PROFILES')
+    if overrides:
+        try:
+            overrides = json.loads(overrides)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid TARGET_IP_PROFILES: {str(e)}")
+        if not isinstance(overrides, dict):
+            raise ValueError("Invalid TARGET_IP_PROFILES: must be a JSON object")
+        profiles.update(overrides)
+    return profiles
+
 def _is_valid_ip(ip: str) -> bool:
     """
     验证IP地址格式是否有效
@@ -192,6 +619,1421 @@ def _is_valid_region(region: str) -> bool:
     region_pattern = r'^[a-z]{2,3}-[a-z]+-\d+$'
     return bool(re.match(region_pattern, region))
 
+def apply_target_ip_profile(profile_name: str, tag_key: str, tag_value: Optional[str] = None,
+                            region: str = None, account_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    将目标IP profile应用到所有带指定标签的FORWARD规则
+    
+    规则集合只解析一次（标签查询 + 规则列表各一次分页调用），已经是目标配置的规则
+    直接跳过，其余规则并发提交update_resolver_rule，整体耗时接近单次更新的往返时间。
+    
+    Args:
+        profile_name: TARGET_IP_PROFILES中的profile名称
+        tag_key: 规则标签键
+        tag_value: 规则标签值，未指定时匹配任意值
+        region: AWS区域名称，如果未指定则使用默认区域
+        account_id: 规则所属账户，指定时扮演该账户中的角色执行
+    
+    Returns:
+        包含matched、updated、skipped、failed计数和每条规则结果的字典
+    
+    Raises:
+        ValueError: profile不存在或参数无效
+        ClientError: 解析规则集合失败
+    """
+    target_ips_config = get_target_ip_profile(profile_name)
+    if region and not _is_valid_region(region):
+        raise ValueError(f"Invalid AWS region format: {region}")
+    
+    rules = _resolve_tagged_forward_rules(tag_key, tag_value, region, account_id)
+    target_ips = [target['Ip'] for target in target_ips_config]
+    logger.info(f"Applying profile {profile_name} {target_ips} to {len(rules)} rules tagged {tag_key}={tag_value}")
+    
+    results = []
+    pending = []
+    for rule in rules:
+        if _same_target_ips(rule.get('TargetIps', []), target_ips_config):
+            results.append({'resolver_rule_id': rule['Id'], 'status': 'SKIPPED'})
+        else:
+            pending.append(rule)
+    
+    def update_rule(rule: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return update_resolver_rule_target_ips(rule['Id'], target_ips, region, current_rule=rule,
+                                                   account_id=account_id, target_ips_config=target_ips_config)
+        except (ClientError, ValueError) as e:
+            return {'resolver_rule_id': rule['Id'], **_failure_result(e)}
+    
+    if pending:
+        with _ProfiledThreadPoolExecutor(max_workers=min(MAX_UPDATE_WORKERS, len(pending))) as executor:
+            results.extend(executor.map(update_rule, pending))
+    
+    failed = sum(1 for result in results if result['status'] == 'FAILED')
+    skipped = len(rules) - len(pending)
+    return {
+        'profile': profile_name,
+        'target_ips': target_ips,
+        'matched': len(rules),
+        'updated': len(pending) - failed,
+        'skipped': skipped,
+        'failed': failed,
+        'results': results
+    }
+
+def _resolve_tagged_forward_rules(tag_key: str, tag_value: Optional[str], region: Optional[str],
+                                  account_id: Optional[str]) -> List[Dict[str, Any]]:
+    """
+    解析带指定标签的FORWARD规则
+    
+    Args:
+        tag_key: 规则标签键
+        tag_value: 规则标签值，未指定时匹配任意值
+        region: AWS区域名称
+        account_id: 规则所属账户
+    
+    Returns:
+        list_resolver_rules返回格式的规则列表（包含当前TargetIps）
+    """
+    tagging = _get_tagging_client(region, account_id)
+    tag_filter = {'Key': tag_key}
+    if tag_value is not None:
+        tag_filter['Values'] = [tag_value]
+    
+    tagged_arns = set()
+    for page in tagging.get_paginator('get_resources').paginate(
+            ResourceTypeFilters=['route53resolver:resolver-rule'], TagFilters=[tag_filter]):
+        tagged_arns.update(resource['ResourceARN'] for resource in page['ResourceTagMappingList'])
+    
+    rules = []
+    if tagged_arns:
+        route53resolver = _get_resolver_client(region, account_id)
+        for page in route53resolver.get_paginator('list_resolver_rules').paginate():
+            rules.extend(rule for rule in page['ResolverRules']
+                         if rule['Arn'] in tagged_arns and rule['RuleType'] == 'FORWARD')
+    return rules
+
+def _get_tagging_client(region: Optional[str], account_id: Optional[str]) -> Any:
+    """
+    获取Resource Groups Tagging API客户端
+    """
+    client_kwargs = {'region_name': region} if region else {}
+    if account_id:
+        credentials = CREDENTIAL_CACHE.get_credentials(account_id)
+        client_kwargs.update(
+            aws_access_key_id=credentials['access_key_id'],
+            aws_secret_access_key=credentials['secret_access_key'],
+            aws_session_token=credentials['session_token']
+        )
+    return boto3.Session().client('resourcegroupstaggingapi', **client_kwargs)
+
+def _same_target_ips(current: List[Dict[str, Any]], desired: List[Dict[str, Any]]) -> bool:
+    """
+    比较两组TargetIps是否一致（忽略顺序）
+    """
+    def normalize(targets: List[Dict[str, Any]]) -> List[Any]:
+        return sorted((target.get('Ip'), target.get('Port', 53)) for target in targets)
+    return normalize(current) == normalize(desired)
+
+def _profile_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    处理按profile批量更新的请求
+    """
+    tag_key = event.get('tag_key')
+    if not tag_key:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'tag_key is required when target_ip_profile is set'
+            })
+        }
+    
+    try:
+        get_target_ip_profile(event['target_ip_profile'])
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': str(e)
+            })
+        }
+    
+    result = apply_target_ip_profile(
+        event['target_ip_profile'],
+        tag_key,
+        event.get('tag_value'),
+        event.get('region'),
+        event.get('account_id')
+    )
+    
+    return {
+        'statusCode': 500 if result['failed'] else 200,
+        'body': json.dumps({
+            'message': 'Some resolver rule updates failed' if result['failed']
+            else 'Target IP profile applied successfully',
+            'region': event.get('region') or 'default',
+            'result': result
+        })
+    }
+
+def run_batch_updates(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    以检查点状态机批量更新多个Resolver Rule的目标IP
+    
+    状态机分为discover（读取当前规则，目标IP已一致的规则直接跳过）和update（提交更新）
+    两个阶段，每条规则的读取结果和更新结果都记录在状态中。剩余时间不足时把状态编码为continuation_token
+    返回，携带token再次调用会从未完成的规则继续，不会重复读取或重复更新。
+    
+    Args:
+        event: 包含updates列表和region，或包含continuation_token
+        context: Lambda上下文
+    
+    Returns:
+        全部完成时返回200（有失败时为500），未完成时返回202和continuation_token
+    """
+    if event.get('continuation_token'):
+        state = decode_continuation_token(event['continuation_token'])
+        if state.get('mode') == 'rollout':
+            raise ValueError("Rollout checkpoints must be resumed with rollout.continuation_token")
+        logger.info(f"Resuming from checkpoint: phase={state['phase']}, updates={len(state['updates'])}")
+    else:
+        state = new_batch_state(event.get('updates'), event.get('region'))
+        logger.info(f"Starting batch update of {len(state['updates'])} resolver rules")
+    
+    if state['phase'] == 'discover':
+        if not _run_per_account(state, context, _discover_rules):
+            return _checkpoint_response(state)
+        state['phase'] = 'update'
+    
+    if state['phase'] == 'update':
+        if not _run_per_account(state, context, _update_rules):
+            return _checkpoint_response(state)
+        state['phase'] = 'done'
+    
+    return _batch_result_response(state)
+
+def new_batch_state(updates: Any, region: Optional[str]) -> Dict[str, Any]:
+    """
+    校验批量更新参数并生成初始状态
+    
+    Args:
+        updates: 每项包含resolver_rule_id和target_ips的列表
+        region: AWS区域名称
+    
+    Returns:
+        初始状态字典
+    
+    Raises:
+        ValueError: 输入参数无效
+    """
+    if not updates or not isinstance(updates, list):
+        raise ValueError("updates must be a non-empty list")
+    if region and not _is_valid_region(region):
+        raise ValueError(f"Invalid AWS region format: {region}")
+    
+    state_updates = []
+    for index, update in enumerate(updates):
+        resolver_rule_id = update.get('resolver_rule_id')
+        target_ips = update.get('target_ips')
+        account_id = update.get('account_id')
+        
+        if not resolver_rule_id:
+            raise ValueError(f"updates[{index}].resolver_rule_id is required")
+        if not target_ips or not isinstance(target_ips, list):
+            raise ValueError(f"updates[{index}].target_ips must be a non-empty list")
+        _build_target_ips_config(target_ips)
+        if account_id is not None and not _is_valid_account_id(account_id):
+            raise ValueError(f"updates[{index}].account_id is invalid: {account_id}")
+        
+        state_updates.append({
+            'resolver_rule_id': resolver_rule_id,
+            'target_ips': target_ips,
+            'account_id': account_id,
+            'current_rule': None,
+            'result': None
+        })
+    
+    return {
+        'version': CHECKPOINT_VERSION,
+        'phase': 'discover',
+        'region': region,
+        'updates': state_updates
+    }
+
+def encode_continuation_token(state: Dict[str, Any]) -> str:
+    """
+    将状态压缩编码为continuation_token
+    
+    Args:
+        state: 批量更新状态
+    
+    Returns:
+        URL安全的token字符串
+    """
+    raw = json.dumps(state, separators=(',', ':'), default=str).encode('utf-8')
+    return base64.urlsafe_b64encode(zlib.compress(raw)).decode('ascii')
+
+def decode_continuation_token(token: str) -> Dict[str, Any]:
+    """
+    解码continuation_token
+    
+    Args:
+        token: encode_continuation_token生成的字符串
+    
+    Returns:
+        批量更新状态
+    
+    Raises:
+        ValueError: token格式无效或版本不匹配
+    """
+    try:
+        state = json.loads(zlib.decompress(base64.urlsafe_b64decode(token.encode('ascii'))))
+    except Exception:
+        raise ValueError("Invalid continuation_token")
+    
+    if not isinstance(state, dict) or state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError("Unsupported continuation_token version")
+    return state
+
+def _time_is_running_out(context: Any) -> bool:
+    """
+    判断Lambda剩余执行时间是否已低于检查点阈值（本地调用时没有context，视为时间充足）
+    """
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        return False
+    return get_remaining() < CHECKPOINT_MARGIN_MS
+
+def _run_per_account(state: Dict[str, Any], context: Any, worker: Any) -> bool:
+    """
+    按账户分组并发执行worker，同一账户内的规则按原有顺序串行处理
+    
+    Args:
+        state: 批量更新状态
+        context: Lambda上下文
+        worker: worker(route53resolver, state, indexes, context)，时间不足时返回False
+    
+    Returns:
+        所有账户都处理完时返回True，任一账户因时间不足提前停止时返回False
+    """
+    groups: Dict[Optional[str], List[int]] = {}
+    for index, update in enumerate(state['updates']):
+        groups.setdefault(update.get('account_id'), []).append(index)
+    
+    def run_group(account_id: Optional[str], indexes: List[int]) -> bool:
+        try:
+            route53resolver = _get_resolver_client(state['region'], account_id)
+        except (ClientError, BotoCoreError) as e:
+            # 无法获取该账户的凭证（AssumeRole被拒绝，或STS端点无法连接），该账户下未完成的规则全部记为失败
+            logger.error(f"Failed to get credentials for account {account_id}: {str(e)}")
+            for index in indexes:
+                if state['updates'][index]['result'] is None:
+                    state['updates'][index]['result'] = _failure_result(e)
+            return True
+        return worker(route53resolver, state, indexes, context)
+    
+    if len(groups) == 1:
+        return all(run_group(account_id, indexes) for account_id, indexes in groups.items())
+    
+    with _ProfiledThreadPoolExecutor(max_workers=min(MAX_ACCOUNT_WORKERS, len(groups))) as executor:
+        futures = [executor.submit(run_group, account_id, indexes) for account_id, indexes in groups.items()]
+        return all([future.result() for future in futures])
+
+def _discover_rules(route53resolver: Any, state: Dict[str, Any], indexes: List[int], context: Any) -> bool:
+    """
+    读取每条规则的当前配置，目标IP已经一致的规则直接记为SKIPPED，时间不足时返回False
+    """
+    seen_rule_ids = set()
+    for index in indexes:
+        update = state['updates'][index]
+        # 同一规则在批次中出现多次时，后面的更新要和前面的更新结果比较，不能按当前配置跳过
+        repeated = update['resolver_rule_id'] in seen_rule_ids
+        seen_rule_ids.add(update['resolver_rule_id'])
+        if update['current_rule'] is not None or update['result'] is not None:
+            continue
+        if _time_is_running_out(context):
+            return False
+        
+        try:
+            rule = route53resolver.get_resolver_rule(ResolverRuleId=update['resolver_rule_id'])['ResolverRule']
+            if not repeated and _same_target_ips(rule.get('TargetIps', []),
+                                                 _build_target_ips_config(update['target_ips'])):
+                logger.info(f"Resolver rule {update['resolver_rule_id']} already has the target IPs, skipping")
+                update['result'] = {'status': 'SKIPPED'}
+                continue
+            # 只保留更新所需的字段，控制token大小
+            update['current_rule'] = {
+                'Status': rule['Status']
+            }
+        except ClientError as e:
+            # 读取失败的规则直接记录失败结果，更新阶段不再处理
+            update['result'] = _failure_result(e)
+    
+    return True
+
+def _update_rules(route53resolver: Any, state: Dict[str, Any], indexes: List[int], context: Any) -> bool:
+    """
+    按读取到的规则提交目标IP更新，时间不足时返回False
+    """
+    for index in indexes:
+        update = state['updates'][index]
+        if update['result'] is not None:
+            continue
+        if _time_is_running_out(context):
+            return False
+        
+        try:
+            update['result'] = update_resolver_rule_target_ips(
+                update['resolver_rule_id'],
+                update['target_ips'],
+                state['region'],
+                current_rule=update['current_rule'],
+                account_id=update['account_id']
+            )
+        except (ClientError, ValueError) as e:
+            update['result'] = _failure_result(e)
+    
+    return True
+
+def _failure_result(error: Exception) -> Dict[str, Any]:
+    """
+    将单条规则的错误转换为失败结果
+    """
+    if isinstance(error, ClientError):
+        message = f"{error.response['Error']['Code']}: {error.response['Error']['Message']}"
+    else:
+        message = str(error)
+    return {
+        'status': 'FAILED',
+        'error': message
+    }
+
+def _checkpoint_response(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    剩余时间不足时返回进度和continuation_token
+    """
+    completed = sum(1 for update in state['updates'] if update['result'] is not None)
+    logger.info(f"Running out of time, checkpointing: phase={state['phase']}, "
+                f"completed={completed}/{len(state['updates'])}")
+    
+    return {
+        'statusCode': 202,
+        'body': json.dumps({
+            'message': 'Batch update not finished, invoke again with continuation_token',
+            'phase': state['phase'],
+            'completed': completed,
+            'total': len(state['updates']),
+            'continuation_token': encode_continuation_token(state)
+        })
+    }
+
+def _batch_result_response(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    批量更新全部结束后的响应，存在失败规则时返回500
+    """
+    results = [
+        {'resolver_rule_id': update['resolver_rule_id'], 'account_id': update['account_id'], **update['result']}
+        for update in state['updates']
+    ]
+    failed = [result for result in results if result['status'] == 'FAILED']
+    
+    if failed:
+        logger.error(f"Batch update finished with {len(failed)}/{len(results)} failures")
+    else:
+        logger.info(f"Batch update of {len(results)} resolver rules finished successfully")
+    
+    return {
+        'statusCode': 500 if failed else 200,
+        'body': json.dumps({
+            'message': 'Some resolver rule updates failed' if failed else 'Resolver rules updated successfully',
+            'region': state['region'] or 'default',
+            'total': len(results),
+            'failed': len(failed),
+            'results': results
+        })
+    }
+
+def plan_waves(total: int, canary_percent: float = 10, growth_factor: float = 2) -> List[int]:
+    """
+    计算分波次更新时每一波的规则数量
+    
+    Args:
+        total: 规则总数
+        canary_percent: 第一波（金丝雀）占比，至少1条
+        growth_factor: 之后每波相对上一波的放大倍数
+    
+    Returns:
+        每一波的数量列表
+    """
+    if total <= 0:
+        return []
+    
+    sizes = []
+    size = max(1, math.ceil(total * canary_percent / 100))
+    remaining = total
+    while remaining > 0:
+        size = min(size, remaining)
+        sizes.append(size)
+        remaining -= size
+        size = max(size + 1, math.ceil(size * growth_factor))
+    return sizes
+
+def new_rollout_state(resolver_rule_ids: List[str], target_ips_config: List[Dict[str, Any]], region: str = None,
+                      account_id: Optional[str] = None, canary_percent: float = 10, growth_factor: float = 2,
+                      max_parallel: int = 10, bake_seconds: float = 0,
+                      health_alarm_names: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    校验分波次更新参数并生成初始状态
+    
+    Args:
+        resolver_rule_ids: 要更新的规则ID列表
+        target_ips_config: TargetIps配置（参见_build_target_ips_config）
+        region: AWS区域名称，如果未指定则使用默认区域
+        account_id: 规则所属账户，指定时扮演该账户中的角色执行
+        canary_percent: 第一波（金丝雀）占比
+        growth_factor: 之后每波相对上一波的放大倍数
+        max_parallel: 每波内的最大并发数
+        bake_seconds: 每波更新完成后、健康检查前的观察时间
+        health_alarm_names: 健康检查时要求不处于ALARM状态的CloudWatch告警
+    
+    Returns:
+        分波次更新状态
+    
+    Raises:
+        ValueError: 输入参数无效
+    """
+    if not resolver_rule_ids:
+        raise ValueError("resolver_rule_ids must be a non-empty list")
+    if not 0 < canary_percent <= 100:
+        raise ValueError("canary_percent must be in (0, 100]")
+    if growth_factor < 1:
+        raise ValueError("growth_factor must be >= 1")
+    if region and not _is_valid_region(region):
+        raise ValueError(f"Invalid AWS region format: {region}")
+    
+    waves = plan_waves(len(resolver_rule_ids), canary_percent, growth_factor)
+    return {
+        'version': CHECKPOINT_VERSION,
+        'mode': 'rollout',
+        'phase': 'update',
+        'region': region,
+        'account_id': account_id,
+        'resolver_rule_ids': list(resolver_rule_ids),
+        'target_ips_config': target_ips_config,
+        'waves': waves,
+        'max_parallel': max_parallel,
+        'bake_seconds': bake_seconds,
+        'health_alarm_names': health_alarm_names or [],
+        'wave_index': 0,
+        'wave_results': [None] * waves[0],
+        'bake_until': None,
+        # 规则ID -> 更新前的TargetIps，用于回滚
+        'previous_configs': {},
+        'rollback_results': None,
+        'report': {'status': 'in_progress', 'waves': [], 'rolled_back': []}
+    }
+
+def rollout_target_ips(state: Dict[str, Any], context: Any = None) -> bool:
+    """
+    按波次更新多条规则的目标IP，任一波不健康时停止并把已更新的规则恢复为原配置
+    
+    每波内的规则以max_parallel条一批并发更新。更新、观察和回滚的进度都记录在state中，
+    剩余时间不足时提前返回，调用方保存state后下次调用继续。
+    
+    Args:
+        state: new_rollout_state生成或从continuation_token恢复的状态
+        context: Lambda上下文，用于检查剩余执行时间
+    
+    Returns:
+        全部结束时返回True，结果（status为completed或rolled_back）在state['report']中；
+        剩余时间不足时返回False
+    """
+    route53resolver = _get_resolver_client(state['region'], state['account_id'])
+    cloudwatch = None
+    if state['health_alarm_names']:
+        cloudwatch = boto3.client('cloudwatch', **({'region_name': state['region']} if state['region'] else {}))
+    
+    target_ips_config = state['target_ips_config']
+    previous_configs = state['previous_configs']
+    report = state['report']
+    
+    while state['phase'] in ('update', 'bake'):
+        wave_number = state['wave_index'] + 1
+        start = sum(state['waves'][:state['wave_index']])
+        wave_rule_ids = state['resolver_rule_ids'][start:start + state['waves'][state['wave_index']]]
+        
+        if state['phase'] == 'update':
+            def update_rule(resolver_rule_id: str, progress: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+                return _rollout_rule(route53resolver, resolver_rule_id, target_ips_config, previous_configs,
+                                     context, progress)
+            
+            if not _run_resumable(update_rule, wave_rule_ids, state['wave_results'], state['max_parallel'], context):
+                return False
+            if state['bake_seconds'] and all(result['status'] != 'FAILED' for result in state['wave_results']):
+                logger.info(f"Wave {wave_number} applied, baking for {state['bake_seconds']} seconds")
+                state['bake_until'] = time.time() + state['bake_seconds']
+            state['phase'] = 'bake'
+        
+        if not _bake(state, context):
+            return False
+        
+        results = state['wave_results']
+        healthy, reason = _wave_is_healthy(results, state['health_alarm_names'], cloudwatch)
+        report['waves'].append({
+            'wave': wave_number,
+            'resolver_rule_ids': wave_rule_ids,
+            'healthy': healthy,
+            'results': results
+        })
+        
+        if not healthy:
+            logger.error(f"Wave {wave_number} unhealthy ({reason}), rolling back {len(previous_configs)} rules")
+            report['reason'] = reason
+            state['phase'] = 'rollback'
+            state['rollback_results'] = [None] * len(previous_configs)
+            break
+        
+        logger.info(f"Wave {wave_number}/{len(state['waves'])} healthy")
+        state['wave_index'] += 1
+        state['bake_until'] = None
+        if state['wave_index'] == len(state['waves']):
+            state['phase'] = 'done'
+            report['status'] = 'completed'
+        else:
+            state['phase'] = 'update'
+            state['wave_results'] = [None] * state['waves'][state['wave_index']]
+    
+    if state['phase'] == 'rollback':
+        if not _rollback_rules(route53resolver, previous_configs, state['rollback_results'],
+                               state['max_parallel'], context):
+            return False
+        report['status'] = 'rolled_back'
+        report['rolled_back'] = state['rollback_results']
+        state['phase'] = 'done'
+    
+    return True
+
+def _run_resumable(func: Any, items: List[Any], results: List[Optional[Dict[str, Any]]], max_parallel: int,
+                   context: Any) -> bool:
+    """
+    分批并发执行func(item, progress)，结果写回results中对应的位置
+    
+    results中为None或状态为PENDING的项尚未完成，progress为该项上次保存的进度。每批最多
+    max_parallel个，开始前检查剩余时间。
+    
+    Returns:
+        全部完成时返回True；剩余时间不足或本批有项需要下次调用继续时返回False
+    """
+    while True:
+        todo = [index for index, result in enumerate(results) if result is None or result['status'] == 'PENDING']
+        if not todo:
+            return True
+        if _time_is_running_out(context):
+            return False
+        
+        batch = todo[:max_parallel]
+        with _ProfiledThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(batch)))) as executor:
+            batch_results = list(executor.map(lambda index: func(items[index], results[index]), batch))
+        for index, result in zip(batch, batch_results):
+            results[index] = result
+        if any(result['status'] == 'PENDING' for result in batch_results):
+            return False
+
+def _bake(state: Dict[str, Any], context: Any) -> bool:
+    """
+    等待本波的观察期结束
+    
+    Returns:
+        观察期已结束返回True，剩余执行时间不足时返回False
+    """
+    remaining = (state['bake_until'] or 0) - time.time()
+    if remaining <= 0:
+        return True
+    budget = _wait_budget(context, remaining)
+    time.sleep(budget)
+    return budget >= remaining
+
+def _wait_budget(context: Any, timeout: float) -> float:
+    """
+    本次调用中最多可以等待的秒数：不超过timeout，也不超过剩余执行时间减去检查点阈值
+    """
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        return timeout
+    return max(0, min(timeout, (get_remaining() - CHECKPOINT_MARGIN_MS) / 1000))
+
+def _rollout_rule(route53resolver: Any, resolver_rule_id: str, target_ips_config: List[Dict[str, Any]],
+                  previous_configs: Dict[str, List[Dict[str, Any]]], context: Any = None,
+                  progress: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    更新单条规则并等待更新完成，记录原配置以便回滚
+    
+    progress为上次调用中已提交更新、尚未等到完成的结果，此时只继续等待
+    """
+    try:
+        if not progress:
+            rule = route53resolver.get_resolver_rule(ResolverRuleId=resolver_rule_id)['ResolverRule']
+            if _same_target_ips(rule.get('TargetIps', []), target_ips_config):
+                return {'resolver_rule_id': resolver_rule_id, 'status': 'SKIPPED'}
+            
+            previous_configs[resolver_rule_id] = rule.get('TargetIps', [])
+            route53resolver.update_resolver_rule(
+                ResolverRuleId=resolver_rule_id,
+                Config={'TargetIps': target_ips_config}
+            )
+        status = _wait_for_rule_update(route53resolver, resolver_rule_id, context)
+        return {'resolver_rule_id': resolver_rule_id, 'status': status or 'PENDING'}
+    
+    except ClientError as e:
+        return {'resolver_rule_id': resolver_rule_id, **_failure_result(e)}
+
+def _wait_for_rule_update(route53resolver: Any, resolver_rule_id: str, context: Any = None) -> Optional[str]:
+    """
+    轮询规则状态直到更新完成，最多等待RULE_UPDATE_TIMEOUT，且不超过剩余执行时间
+    
+    Returns:
+        COMPLETE，更新失败或等满RULE_UPDATE_TIMEOUT仍未完成时返回FAILED；
+        剩余执行时间不足、需要下次调用继续等待时返回None
+    """
+    budget = _wait_budget(context, RULE_UPDATE_TIMEOUT)
+    deadline = time.time() + budget
+    while True:
+        status = route53resolver.get_resolver_rule(ResolverRuleId=resolver_rule_id)['ResolverRule']['Status']
+        if status in ('COMPLETE', 'FAILED'):
+            return status
+        if time.time() >= deadline:
+            if budget < RULE_UPDATE_TIMEOUT:
+                return None
+            logger.error(f"Timed out waiting for resolver rule {resolver_rule_id}, last status: {status}")
+            return 'FAILED'
+        time.sleep(max(0, min(RULE_POLL_INTERVAL, deadline - time.time())))
+
+def _wave_is_healthy(results: List[Dict[str, Any]], health_alarm_names: Optional[List[str]],
+                     cloudwatch: Any) -> Any:
+    """
+    检查一波更新是否健康：所有规则更新完成，且指定的CloudWatch告警（指标告警或复合告警）
+    都存在并且不处于ALARM状态
+    
+    Returns:
+        (是否健康, 不健康的原因)
+    """
+    failed = [result['resolver_rule_id'] for result in results if result['status'] == 'FAILED']
+    if failed:
+        return False, f"Failed rules: {failed}"
+    
+    if health_alarm_names:
+        alarms = cloudwatch.describe_alarms(
+            AlarmNames=health_alarm_names,
+            AlarmTypes=['MetricAlarm', 'CompositeAlarm']
+        )
+        alarms = alarms.get('MetricAlarms', []) + alarms.get('CompositeAlarms', [])
+        # 告警名称写错或告警已被删除时无法判断健康状态，按不健康处理
+        missing = sorted(set(health_alarm_names) - {alarm['AlarmName'] for alarm in alarms})
+        if missing:
+            return False, f"Alarms not found: {missing}"
+        firing = [alarm['AlarmName'] for alarm in alarms if alarm['StateValue'] == 'ALARM']
+        if firing:
+            return False, f"Alarms firing: {firing}"
+    
+    return True, None
+
+def _rollback_rules(route53resolver: Any, previous_configs: Dict[str, List[Dict[str, Any]]],
+                   results: List[Optional[Dict[str, Any]]], max_parallel: int, context: Any = None) -> bool:
+    """
+    并发把规则恢复为更新前的TargetIps，并等待恢复完成后才记为RESTORED
+    
+    Args:
+        route53resolver: Route53 Resolver客户端
+        previous_configs: 规则ID -> 更新前的TargetIps
+        results: 与previous_configs顺序对应的回滚结果，结果原地写入
+        max_parallel: 最大并发数
+        context: Lambda上下文，用于检查剩余执行时间
+    
+    Returns:
+        全部回滚结束返回True，剩余执行时间不足时返回False
+    """
+    def restore(item: Any, progress: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        resolver_rule_id, target_ips = item
+        try:
+            if not progress:
+                route53resolver.update_resolver_rule(
+                    ResolverRuleId=resolver_rule_id,
+                    Config={'TargetIps': target_ips}
+                )
+            status = _wait_for_rule_update(route53resolver, resolver_rule_id, context)
+            if status is None:
+                return {'resolver_rule_id': resolver_rule_id, 'status': 'PENDING'}
+            if status == 'FAILED':
+                return {'resolver_rule_id': resolver_rule_id, 'status': 'FAILED',
+                        'error': 'Rule update did not complete while restoring target IPs'}
+            return {'resolver_rule_id': resolver_rule_id, 'status': 'RESTORED'}
+        except ClientError as e:
+            return {'resolver_rule_id': resolver_rule_id, **_failure_result(e)}
+    
+    return _run_resumable(restore, list(previous_configs.items()), results, max_parallel, context)
+
+def _rollout_response(event: Dict[str, Any], context: Any = None) -> Dict[str, Any]:
+    """
+    处理分波次金丝雀更新请求
+    
+    rollout中通过resolver_rule_ids或tag_key/tag_value指定规则，
+    通过target_ips或target_ip_profile指定目标IP；rollout.continuation_token存在时从检查点继续
+    """
+    rollout = event['rollout']
+    if rollout.get('continuation_token'):
+        state = decode_continuation_token(rollout['continuation_token'])
+        if state.get('mode') != 'rollout':
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': 'continuation_token is not a rollout checkpoint'
+                })
+            }
+        logger.info(f"Resuming rollout from checkpoint: phase={state['phase']}, "
+                    f"wave={state['wave_index'] + 1}/{len(state['waves'])}")
+    else:
+        state = None
+    
+    region = state['region'] if state else event.get('region')
+    account_id = state['account_id'] if state else event.get('account_id')
+    
+    if state is None:
+        if rollout.get('target_ip_profile'):
+            try:
+                target_ips_config = get_target_ip_profile(rollout['target_ip_profile'])
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'error': str(e)
+                    })
+                }
+        else:
+            target_ips_config = _build_target_ips_config(rollout.get('target_ips') or [])
+        if not target_ips_config:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': 'rollout requires target_ips or target_ip_profile'
+                })
+            }
+        
+        resolver_rule_ids = rollout.get('resolver_rule_ids')
+        if not resolver_rule_ids and rollout.get('tag_key'):
+            rules = _resolve_tagged_forward_rules(rollout['tag_key'], rollout.get('tag_value'), region, account_id)
+            resolver_rule_ids = [rule['Id'] for rule in rules]
+        if not resolver_rule_ids:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': 'rollout requires resolver_rule_ids or tag_key matching at least one rule'
+                })
+            }
+        
+        state = new_rollout_state(
+            resolver_rule_ids,
+            target_ips_config,
+            region,
+            account_id,
+            canary_percent=rollout.get('canary_percent', 10),
+            growth_factor=rollout.get('growth_factor', 2),
+            max_parallel=rollout.get('max_parallel', 10),
+            bake_seconds=rollout.get('bake_seconds', 0),
+            health_alarm_names=rollout.get('health_alarm_names')
+        )
+        logger.info(f"Starting rollout of {[t['Ip'] for t in target_ips_config]} to "
+                    f"{len(resolver_rule_ids)} rules in waves {state['waves']}")
+    
+    if not rollout_target_ips(state, context):
+        logger.info(f"Running out of time, checkpointing rollout: phase={state['phase']}, "
+                    f"wave={state['wave_index'] + 1}/{len(state['waves'])}")
+        return {
+            'statusCode': 202,
+            'body': json.dumps({
+                'message': 'Rollout not finished, invoke again with rollout.continuation_token',
+                'phase': state['phase'],
+                'wave': state['wave_index'] + 1,
+                'total_waves': len(state['waves']),
+                'continuation_token': encode_continuation_token(state)
+            })
+        }
+    
+    report = state['report']
+    completed = report['status'] == 'completed'
+    return {
+        'statusCode': 200 if completed else 500,
+        'body': json.dumps({
+            'message': 'Rollout completed successfully' if completed else 'Rollout halted and rolled back',
+            'region': region or 'default',
+            'result': report
+        })
+    }
+
+def process_records(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    处理SQS批量消息，返回batchItemFailures（需要在事件源映射中启用ReportBatchItemFailures）
+    
+    同一规则的多条消息只执行最后一条（最终期望的目标IP），被合并的消息与其共享结果；
+    不同规则并发更新。
+    
+    Args:
+        event: 包含Records的SQS事件
+        context: Lambda上下文
+    
+    Returns:
+        {'batchItemFailures': [{'itemIdentifier': messageId}, ...]}
+    """
+    records = event['Records']
+    failed_message_ids = []
+    latest: Dict[Any, Dict[str, Any]] = {}
+    held_keys = set()
+    
+    for record in records:
+        message_id = record.get('messageId')
+        try:
+            update = _parse_record(record)
+        except ValueError as e:
+            logger.error(f"Failed to parse message {message_id}: {str(e)}")
+            failed_message_ids.append(message_id)
+            continue
+        
+        # 已成功处理过的消息（重复投递或带相同幂等键）直接确认；幂等键被不同的请求复用时
+        # 按失败处理，多次重试后进入死信队列
+        try:
+            cached = IDEMPOTENCY_CACHE.get(update['idempotency_key'], update['fingerprint'])
+        except ValueError as e:
+            logger.error(f"Message {message_id}: {str(e)}")
+            failed_message_ids.append(message_id)
+            continue
+        if cached is not None:
+            logger.info(f"Message {message_id} already processed, skipping")
+            continue
+        # 同一幂等键正在被其他调用处理时稍后重新投递；本批次中已占用的键不再重复占用
+        if update['idempotency_key'] not in held_keys:
+            if not IDEMPOTENCY_CACHE.acquire(update['idempotency_key'], update['fingerprint']):
+                logger.warning(f"Message {message_id} is being processed by another request, retrying later")
+                failed_message_ids.append(message_id)
+                continue
+            held_keys.add(update['idempotency_key'])
+        
+        key = (update['account_id'], update['region'], update['resolver_rule_id'])
+        superseded = latest.pop(key, None)
+        update['message_ids'] = (superseded['message_ids'] if superseded else []) + [message_id]
+        update['idempotency_keys'] = (superseded['idempotency_keys'] if superseded else []) + \
+            [(update['idempotency_key'], update['fingerprint'])]
+        latest[key] = update
+    
+    logger.info(f"Received {len(records)} messages, {len(latest)} distinct rule updates after dedupe")
+    
+    def apply(update: Dict[str, Any]) -> List[str]:
+        try:
+            target_ips = [target['Ip'] for target in update['target_ips_config']]
+            result = update_resolver_rule_target_ips(
+                update['resolver_rule_id'],
+                target_ips,
+                update['region'],
+                account_id=update['account_id'],
+                target_ips_config=update['target_ips_config']
+            )
+            response = _update_response(update['resolver_rule_id'], update['region'], target_ips, result)
+            for idempotency_key, fingerprint in update['idempotency_keys']:
+                IDEMPOTENCY_CACHE.put(idempotency_key, response, fingerprint)
+            return []
+        except Exception as e:
+            logger.error(f"Failed to update resolver rule {update['resolver_rule_id']}: {str(e)}")
+            for idempotency_key, _ in update['idempotency_keys']:
+                IDEMPOTENCY_CACHE.release(idempotency_key)
+            return update['message_ids']
+    
+    if latest:
+        with _ProfiledThreadPoolExecutor(max_workers=min(MAX_UPDATE_WORKERS, len(latest))) as executor:
+            for message_ids in executor.map(apply, latest.values()):
+                failed_message_ids.extend(message_ids)
+    
+    if failed_message_ids:
+        logger.error(f"{len(failed_message_ids)}/{len(records)} messages failed and will be redelivered")
+    
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
+    }
+
+def _parse_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    把SQS消息解析为单次更新
+    
+    Args:
+        record: SQS消息，body为{resolver_rule_id, target_ips或target_ip_profile, region, account_id}，
+            或detail中包含这些字段的EventBridge事件
+    
+    Returns:
+        包含resolver_rule_id、target_ips_config、region和account_id的字典
+    
+    Raises:
+        ValueError: 消息格式无效
+    """
+    try:
+        payload = json.loads(record['body'])
+    except (KeyError, TypeError, json.JSONDecodeError):
+        raise ValueError("message body is not valid JSON")
+    
+    # EventBridge规则投递到SQS时，更新参数放在detail中
+    if isinstance(payload, dict) and isinstance(payload.get('detail'), dict):
+        payload = payload['detail']
+    if not isinstance(payload, dict):
+        raise ValueError("message body must be a JSON object")
+    
+    resolver_rule_id = payload.get('resolver_rule_id')
+    region = payload.get('region')
+    account_id = payload.get('account_id')
+    
+    if not resolver_rule_id:
+        raise ValueError("resolver_rule_id is required")
+    if payload.get('target_ip_profile'):
+        target_ips_config = get_target_ip_profile(payload['target_ip_profile'])
+    else:
+        target_ips = payload.get('target_ips')
+        if not target_ips or not isinstance(target_ips, list):
+            raise ValueError("target_ips must be a non-empty list")
+        target_ips_config = _build_target_ips_config(target_ips)
+    if region and not _is_valid_region(region):
+        raise ValueError(f"Invalid AWS region format: {region}")
+    if account_id is not None and not _is_valid_account_id(account_id):
+        raise ValueError(f"Invalid account_id: {account_id}")
+    
+    return {
+        'resolver_rule_id': resolver_rule_id,
+        'target_ips_config': target_ips_config,
+        'region': region,
+        'account_id': account_id,
+        # 未指定幂等键时使用messageId，重复投递的同一条消息不会再次执行
+        'idempotency_key': payload.get('idempotency_key') or f"sqs:{record.get('messageId')}",
+        'fingerprint': _request_fingerprint(payload)
+    }
+
+class FileIdempotencyStore:
+    """
+    基于本地文件的持久化后端，每个幂等键一个JSON文件
+    
+    用于本地测试，或在同一容器内跨冷启动保留结果（/tmp在容器回收前一直保留）
+    """
+    
+    def __init__(self, directory: str):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return item if item.get('expires_at', 0) > time.time() else None
+    
+    def put(self, key: str, response: Dict[str, Any], expires_at: float, fingerprint: Optional[str] = None) -> None:
+        self._write(key, {'response': response, 'expires_at': expires_at, 'fingerprint': fingerprint})
+    
+    def acquire(self, key: str, expires_at: float, fingerprint: Optional[str] = None) -> bool:
+        item = {'status': 'INPROGRESS', 'expires_at': expires_at, 'fingerprint': fingerprint}
+        try:
+            fd = os.open(self._path(key), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            # 已过期的记录（包括中断请求留下的占用）可以被覆盖
+            if self.get(key) is not None:
+                return False
+            self._write(key, item)
+            return True
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(item, f)
+        return True
+    
+    def release(self, key: str) -> None:
+        item = self.get(key)
+        if item is not None and item.get('status') == 'INPROGRESS':
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+    
+    def _write(self, key: str, item: Dict[str, Any]) -> None:
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(item, f)
+        os.replace(temp_path, path)
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+class DynamoDBIdempotencyStore:
+    """
+    基于DynamoDB的持久化后端，表的分区键为idempotency_key（字符串），
+    建议在expires_at属性上启用TTL自动清理过期记录
+    """
+    
+    def __init__(self, table_name: str, dynamodb_client: Any = None):
+        self._table_name = table_name
+        self._client = dynamodb_client or boto3.client('dynamodb')
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self._client.get_item(
+            TableName=self._table_name,
+            Key={'idempotency_key': {'S': key}},
+            ConsistentRead=True
+        ).get('Item')
+        if not item:
+            return None
+        
+        # TTL删除有延迟，读取时再检查一次是否过期
+        expires_at = float(item['expires_at']['N'])
+        if expires_at <= time.time():
+            return None
+        return {
+            'response': json.loads(item['response']['S']) if 'response' in item else None,
+            'status': item.get('status', {}).get('S'),
+            'expires_at': expires_at,
+            'fingerprint': item.get('fingerprint', {}).get('S')
+        }
+    
+    def put(self, key: str, response: Dict[str, Any], expires_at: float, fingerprint: Optional[str] = None) -> None:
+        item = {
+            'idempotency_key': {'S': key},
+            'response': {'S': json.dumps(response)},
+            'expires_at': {'N': str(int(expires_at))}
+        }
+        if fingerprint:
+            item['fingerprint'] = {'S': fingerprint}
+        self._client.put_item(TableName=self._table_name, Item=item)
+    
+    def acquire(self, key: str, expires_at: float, fingerprint: Optional[str] = None) -> bool:
+        item = {
+            'idempotency_key': {'S': key},
+            'status': {'S': 'INPROGRESS'},
+            'expires_at': {'N': str(int(expires_at))}
+        }
+        if fingerprint:
+            item['fingerprint'] = {'S': fingerprint}
+        try:
+            # 只有键不存在，或已有记录（结果或中断请求留下的占用）已过期时才能写入
+            self._client.put_item(
+                TableName=self._table_name,
+                Item=item,
+                ConditionExpression='attribute_not_exists(idempotency_key) OR expires_at < :now',
+                ExpressionAttributeValues={':now': {'N': str(int(time.time()))}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+    
+    def release(self, key: str) -> None:
+        try:
+            # 只删除占用记录，不删除已保存的结果
+            self._client.delete_item(
+                TableName=self._table_name,
+                Key={'idempotency_key': {'S': key}},
+                ConditionExpression='#status = :in_progress',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':in_progress': {'S': 'INPROGRESS'}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+class IdempotencyCache:
+    """
+    幂等键结果的两级TTL缓存：容器内存一级，可插拔的持久化后端（get/put）二级
+    
+    每条结果同时保存请求内容的摘要，同一个幂等键被用于不同的请求时拒绝而不是返回旧结果。
+    执行前通过acquire占用幂等键（后端为acquire/release），并发的重复请求不会同时执行。
+    后端不可用时只记录告警并按未命中处理，不影响正常请求
+    """
+    
+    def __init__(self, backend: Any = None, ttl_seconds: int = IDEMPOTENCY_TTL_SECONDS,
+                 namespace: str = 'update-resolver-rule', lock_seconds: int = IDEMPOTENCY_LOCK_SECONDS):
+        self._backend = backend
+        self._ttl_seconds = ttl_seconds
+        self._namespace = namespace
+        self._lock_seconds = lock_seconds
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Any] = {}
+        self._in_progress: Dict[str, float] = {}
+    
+    def get(self, key: str, fingerprint: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        获取幂等键对应的结果
+        
+        Args:
+            key: 幂等键
+            fingerprint: 当前请求的摘要，与保存的摘要不一致时拒绝
+        
+        Returns:
+            之前保存的结果，不存在或已过期时返回None
+        
+        Raises:
+            ValueError: 幂等键已被用于不同的请求
+        """
+        original_key = key
+        key = f"{self._namespace}:{key}"
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._check_fingerprint(original_key, entry[2], fingerprint)
+                    return entry[1]
+                del self._entries[key]
+        
+        if self._backend is None:
+            return None
+        try:
+            item = self._backend.get(key)
+        except Exception as e:
+            logger.warning(f"Failed to read idempotency cache: {str(e)}")
+            return None
+        if item is None:
+            return None
+        
+        self._check_fingerprint(original_key, item.get('fingerprint'), fingerprint)
+        # 其他请求正在执行，尚无结果
+        if item.get('status') == 'INPROGRESS':
+            return None
+        with self._lock:
+            self._entries[key] = (item['expires_at'], item['response'], item.get('fingerprint'))
+        return item['response']
+    
+    def acquire(self, key: str, fingerprint: Optional[str] = None) -> bool:
+        """
+        执行请求前占用幂等键
+        
+        有持久化后端时通过条件写入占用，跨容器生效；占用在lock_seconds后过期，执行中途
+        被中断的请求不会永久占用幂等键
+        
+        Args:
+            key: 幂等键
+            fingerprint: 当前请求的摘要
+        
+        Returns:
+            占用成功返回True，同一个键正在被其他请求处理时返回False
+        """
+        key = f"{self._namespace}:{key}"
+        now = time.time()
+        expires_at = now + self._lock_seconds
+        with self._lock:
+            if self._in_progress.get(key, 0) > now:
+                return False
+            self._in_progress[key] = expires_at
+        
+        if self._backend is None:
+            return True
+        try:
+            acquired = self._backend.acquire(key, expires_at, fingerprint)
+        except Exception as e:
+            logger.warning(f"Failed to acquire idempotency key: {str(e)}")
+            return True
+        if not acquired:
+            with self._lock:
+                self._in_progress.pop(key, None)
+        return acquired
+    
+    def release(self, key: str) -> None:
+        """
+        释放acquire占用的幂等键，请求失败或未完成时调用，允许之后重试
+        """
+        key = f"{self._namespace}:{key}"
+        with self._lock:
+            self._in_progress.pop(key, None)
+        if self._backend is not None:
+            try:
+                self._backend.release(key)
+            except Exception as e:
+                logger.warning(f"Failed to release idempotency key: {str(e)}")
+    
+    def put(self, key: str, response: Dict[str, Any], fingerprint: Optional[str] = None) -> None:
+        """
+        保存幂等键对应的结果
+        
+        Args:
+            key: 幂等键
+            response: 要返回给重复请求的结果
+            fingerprint: 请求内容的摘要
+        """
+        key = f"{self._namespace}:{key}"
+        expires_at = time.time() + self._ttl_seconds
+        with self._lock:
+            self._entries[key] = (expires_at, response, fingerprint)
+            self._in_progress.pop(key, None)
+            # 顺带清理过期的内存条目，避免长时间运行的容器无限增长
+            if len(self._entries) > 10000:
+                now = time.time()
+                for expired in [k for k, entry in self._entries.items() if entry[0] <= now]:
+                    del self._entries[expired]
+        
+        if self._backend is not None:
+            try:
+                self._backend.put(key, response, expires_at, fingerprint)
+            except Exception as e:
+                logger.warning(f"Failed to write idempotency cache: {str(e)}")
+    
+    @staticmethod
+    def _check_fingerprint(key: str, stored: Optional[str], fingerprint: Optional[str]) -> None:
+        # 旧版本保存的结果没有摘要，不做比较
+        if stored and fingerprint and stored != fingerprint:
+            raise ValueError(f"Idempotency key {key} was already used for a different request")
+
+def _request_fingerprint(payload: Dict[str, Any]) -> str:
+    """
+    计算请求内容的摘要，幂等键本身和debug_profile不参与计算
+    
+    单条规则的更新只取规则、规范化后的TargetIps配置、账户和区域，因此IP写成字符串或
+    带默认端口的字典、附带无关字段的重试（包括同一更新的SQS消息和直接调用）得到相同的摘要
+    """
+    is_batch = any(key in payload for key in ('updates', 'continuation_token', 'rollout', 'tag_key'))
+    request = {key: value for key, value in payload.items() if key not in ('idempotency_key', 'debug_profile')}
+    if payload.get('resolver_rule_id') and not is_batch:
+        try:
+            if payload.get('target_ip_profile'):
+                target_ips_config = get_target_ip_profile(payload['target_ip_profile'])
+            else:
+                target_ips_config = _build_target_ips_config(payload.get('target_ips') or [])
+        except (ValueError, TypeError):
+            # 参数无效的请求会被拒绝，摘要只需保持稳定
+            target_ips_config = None
+        if target_ips_config is not None:
+            request = {
+                'resolver_rule_id': payload['resolver_rule_id'],
+                'target_ips_config': target_ips_config,
+                'account_id': payload.get('account_id'),
+                'region': payload.get('region')
+            }
+    raw = json.dumps(request, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def _default_idempotency_backend() -> Any:
+    """
+    根据环境变量选择持久化后端：IDEMPOTENCY_TABLE为DynamoDB表，IDEMPOTENCY_DIR为本地目录
+    """
+    if os.environ.get('IDEMPOTENCY_TABLE'):
+        return DynamoDBIdempotencyStore(os.environ['IDEMPOTENCY_TABLE'])
+    if os.environ.get('IDEMPOTENCY_DIR'):
+        return FileIdempotencyStore(os.environ['IDEMPOTENCY_DIR'])
+    return None
+
+class _WorkerProfiles:
+    """
+    收集一次性能分析期间各工作线程任务的cProfile结果
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profilers: List[Any] = []
+    
+    def run(self, func: Any, *args: Any, **kwargs: Any) -> Any:
+        import cProfile
+        
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12起cProfile基于sys.monitoring，主线程的profiler已经覆盖所有线程
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with self._lock:
+                self.profilers.append(profiler)
+
+# 正在进行性能分析时为_WorkerProfiles实例，否则为None
+_WORKER_PROFILES: Optional[_WorkerProfiles] = None
+
+class _ProfiledThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    性能分析期间在工作线程中为每个任务启用cProfile，未开启分析时与ThreadPoolExecutor相同
+    """
+    
+    def submit(self, fn: Any, /, *args: Any, **kwargs: Any) -> Any:
+        worker_profiles = _WORKER_PROFILES
+        if worker_profiles is None:
+            return super().submit(fn, *args, **kwargs)
+        return super().submit(worker_profiles.run, fn, *args, **kwargs)
+
+def _run_profiled(func: Any, event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    在cProfile和tracemalloc下执行一次调用
+    
+    日志中输出按累计耗时排序的前PROFILE_TOP_N个函数和分配内存最多的代码行，完整的
+    profile写入PROFILE_DIR，可用pstats或snakeviz查看。工作线程中的任务（AWS调用、
+    重试等待、客户端创建）单独采集后与主线程的结果合并。
+    
+    Args:
+        func: 实际的处理函数
+        event: Lambda事件
+        context: Lambda上下文
+    
+    Returns:
+        func的返回值
+    """
+    import cProfile
+    import pstats
+    import tracemalloc
+    global _WORKER_PROFILES
+    
+    request_id = getattr(context, 'aws_request_id', None) or str(int(time.time() * 1000))
+    profiler = cProfile.Profile()
+    worker_profiles = _WORKER_PROFILES = _WorkerProfiles()
+    tracemalloc.start()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        return func(event, context)
+    finally:
+        profiler.disable()
+        _WORKER_PROFILES = None
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        
+        stats = pstats.Stats(profiler)
+        for worker_profiler in worker_profiles.profilers:
+            stats.add(worker_profiler)
+        
+        try:
+            path = os.path.join(PROFILE_DIR, f"profile-{request_id}.prof")
+            stats.dump_stats(path)
+        except OSError as e:
+            path = None
+            logger.warning(f"Failed to write profile: {str(e)}")
+        
+        logger.info(_profile_summary(stats, len(worker_profiles.profilers), snapshot, elapsed_ms, peak, path))
+
+def _profile_summary(stats: Any, worker_tasks: int, snapshot: Any, elapsed_ms: float, peak_bytes: int,
+                     path: Optional[str]) -> str:
+    """
+    生成紧凑的性能分析摘要
+    
+    合并了工作线程的结果后，累计耗时是各线程之和，可能超过调用的实际耗时
+    """
+    top_functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP_N]
+    
+    lines = [f"Profile: {elapsed_ms:.1f}ms wall, {peak_bytes / 1024:.1f}KB peak traced memory, "
+             f"{worker_tasks} worker tasks merged, full profile: {path}",
+             "Top functions by cumulative time (cum ms / self ms / calls):"]
+    for (filename, lineno, function), (_, calls, self_time, cumulative, _) in top_functions:
+        lines.append(f"  {cumulative * 1000:9.1f} {self_time * 1000:9.1f} {calls:7d}  "
+                     f"{function} ({os.path.basename(filename)}:{lineno})")
+    
+    lines.append("Top allocations by line:")
+    for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]:
+        frame = stat.traceback[0]
+        lines.append(f"  {stat.size / 1024:9.1f}KB {stat.count:7d}  {os.path.basename(frame.filename)}:{frame.lineno}")
+    
+    return "\n".join(lines)
+
+# 容器生命周期内共享的幂等缓存，测试时可替换为使用其他后端的实例
+IDEMPOTENCY_CACHE = IdempotencyCache(_default_idempotency_backend())
+
+
 # 用于本地测试的示例函数
 def test_locally():
     """
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+AssociationStore内存与查询性能基准：对比原始boto3字典列表与紧凑存储
+
+用法: python benchmark_association_store.py [关联数量] [规则数量]
+"""
+
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from lambda_function import AssociationStore
+
+LAMBDA_MEMORY_MB = 256
+LOOKUPS = 20000
+
+
+def generate_pages(association_count, rule_count, page_size=100):
+    """
+    按list_resolver_rule_associations的分页格式生成模拟数据
+
+    每页经过JSON序列化再解析，和botocore解析响应一样每条记录都持有独立的字符串对象
+    """
+    rng = random.Random(42)
+    rule_ids = [f"rslvr-rr-{rng.getrandbits(68):017x}" for _ in range(rule_count)]
+    vpc_count = max(1, association_count // 2)
+    vpc_ids = [f"vpc-{rng.getrandbits(68):017x}" for _ in range(vpc_count)]
+
+    page = []
+    pairs = set()
+    while len(pairs) < association_count:
+        rule_id = rng.choice(rule_ids)
+        vpc_id = rng.choice(vpc_ids)
+        if (rule_id, vpc_id) in pairs:
+            continue
+        pairs.add((rule_id, vpc_id))
+        page.append({
+            'Id': f"rslvr-rrassoc-{rng.getrandbits(68):017x}",
+            'ResolverRuleId': rule_id,
+            'Name': f"assoc-{len(pairs)}",
+            'VPCId': vpc_id,
+            'Status': 'COMPLETE',
+            'StatusMessage': ''
+        })
+        if len(page) == page_size:
+            yield json.loads(json.dumps({'ResolverRuleAssociations': page}))
+            page = []
+    if page:
+        yield json.loads(json.dumps({'ResolverRuleAssociations': page}))
+
+
+def measure(build):
+    """返回构建结果及其占用的内存（MB）"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current / 1024 / 1024
+
+
+def time_lookups(lookup, queries):
+    """返回每次查询的平均耗时（微秒）"""
+    start = time.perf_counter()
+    for rule_id, vpc_id in queries:
+        lookup(rule_id, vpc_id)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+
+def main():
+    association_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rule_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    print(f"关联数量: {association_count}, 规则数量: {rule_count}")
+    print("-" * 60)
+
+    # 原始分页字典（当前list_vpc_associations的返回形式）
+    raw, raw_mb = measure(lambda: [
+        association
+        for page in generate_pages(association_count, rule_count)
+        for association in page['ResolverRuleAssociations']
+    ])
+
+    def build_store():
+        store = AssociationStore()
+        for page in generate_pages(association_count, rule_count):
+            for association in page['ResolverRuleAssociations']:
+                store.add(association)
+        return store
+
+    store, store_mb = measure(build_store)
+
+    print(f"原始字典列表:     {raw_mb:8.1f} MB")
+    print(f"AssociationStore: {store_mb:8.1f} MB ({raw_mb / store_mb:.1f}x 更小)")
+
+    rng = random.Random(7)
+    queries = [(a['ResolverRuleId'], a['VPCId']) for a in rng.sample(raw, min(LOOKUPS, len(raw)))]
+
+    def scan(rule_id, vpc_id):
+        for association in raw:
+            if association['ResolverRuleId'] == rule_id and association['VPCId'] == vpc_id:
+                return association
+        return None
+
+    scan_queries = queries[:50]
+    print("-" * 60)
+    print(f"线性扫描查询:     {time_lookups(scan, scan_queries):10.1f} us/次")
+    print(f"Store.find查询:   {time_lookups(store.find, queries):10.2f} us/次")
+
+    sample_rule = queries[0][0]
+    start = time.perf_counter()
+    for _ in range(1000):
+        store.vpc_ids_for_rule(sample_rule)
+    per_rule_us = (time.perf_counter() - start) / 1000 * 1e6
+    print(f"按规则列出VPC:    {per_rule_us:10.1f} us/次 ({len(store.vpc_ids_for_rule(sample_rule))} 个VPC)")
+
+    print("-" * 60)
+    fits = store_mb < LAMBDA_MEMORY_MB / 4
+    print(f"{'✅' if fits else '❌'} 在{LAMBDA_MEMORY_MB}MB Lambda中占用 {store_mb / LAMBDA_MEMORY_MB:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -39,9 +39,25 @@ cat > lambda-policy.json << EOF
                 "route53resolver:AssociateResolverRule",
                 "route53resolver:DisassociateResolverRule",
                 "route53resolver:ListResolverRuleAssociations",
-                "route53resolver:GetResolverRule"
+                "route53resolver:GetResolverRule",
+                "route53resolver:GetResolverRuleAssociation",
+                "cloudwatch:DescribeAlarms"
             ],
             "Resource": "*"
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "dynamodb:GetItem",
+                "dynamodb:PutItem",
+                "dynamodb:DeleteItem"
+            ],
+            "Resource": "arn:aws:dynamodb:*:*:table/route53-resolver-idempotency"
+        },
+        {
+            "Effect": "Allow",
+            "Action": "sts:AssumeRole",
+            "Resource": "arn:aws:iam::*:role/Route53ResolverManagerRole"
         }
     ]
 }
@@ -116,7 +132,7 @@ aws lambda create-function \
     --handler lambda_function.lambda_handler \
     --zip-file fileb://function.zip \
     --description "管理Route53 Resolver规则与VPC的关联" \
-    --timeout 30 \
+    --timeout 900 \
     2>/dev/null
 
 if [ $? -eq 0 ]; then
@@ -128,6 +144,14 @@ else
         --function-name $FUNCTION_NAME \
         --zip-file fileb://function.zip
     
+    # 等待代码更新完成后再更新超时时间（分波次切换需要较长的执行时间）
+    aws lambda wait function-updated --region $REGION --function-name $FUNCTION_NAME && \
+    aws lambda update-function-configuration \
+        --region $REGION \
+        --function-name $FUNCTION_NAME \
+        --timeout 900 \
+        > /dev/null
+    
     if [ $? -eq 0 ]; then
         echo "Lambda函数更新成功!"
     else
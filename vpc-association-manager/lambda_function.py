@@ -1,8 +1,18 @@
 import json
+import math
+import os
+import base64
+import hashlib
+import heapq
+import zlib
 import boto3
 import logging
+import re
 import time
-from botocore.exceptions import ClientError
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from botocore.exceptions import BotoCoreError, ClientError
 from botocore.config import Config
 
 # 配置日志
@@ -17,6 +27,44 @@ RETRY_CONFIG = Config(
     }
 )
 
+# 剩余执行时间低于该值（毫秒）时保存进度并返回continuation_token
+CHECKPOINT_MARGIN_MS = int(os.environ.get('CHECKPOINT_MARGIN_MS', '15000'))
+
+# continuation_token格式版本
+CHECKPOINT_VERSION = 1
+
+# continuation_token超过该字节数时把状态保存到持久化后端（异步调用和Step Functions的载荷上限为256KB）
+CHECKPOINT_INLINE_BYTES = int(os.environ.get('CHECKPOINT_INLINE_BYTES', '200000'))
+CHECKPOINT_TTL_SECONDS = int(os.environ.get('CHECKPOINT_TTL_SECONDS', '86400'))
+CHECKPOINT_REFERENCE_PREFIX = 'ref:'
+
+# 跨账户操作时在成员账户中扮演的角色名称
+CROSS_ACCOUNT_ROLE_NAME = os.environ.get('CROSS_ACCOUNT_ROLE_NAME', 'Route53ResolverManagerRole')
+
+# 多账户并发处理时的最大线程数
+MAX_ACCOUNT_WORKERS = int(os.environ.get('MAX_ACCOUNT_WORKERS', '8'))
+
+# 等待关联创建/删除完成时的轮询间隔（秒）和超时时间（秒）
+ASSOCIATION_POLL_INTERVAL = float(os.environ.get('ASSOCIATION_POLL_INTERVAL', '1'))
+ASSOCIATION_WAIT_TIMEOUT = float(os.environ.get('ASSOCIATION_WAIT_TIMEOUT', '120'))
+
+# 处理SQS批量消息时并发处理的VPC分组数
+MAX_RECORD_WORKERS = int(os.environ.get('MAX_RECORD_WORKERS', '16'))
+
+# 幂等键结果的缓存时间（秒）
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '3600'))
+# 执行中占用幂等键的最长时间，超过后视为执行已中断，允许重试（不小于Lambda超时时间）
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '900'))
+
+# 性能分析：PROFILE_INVOCATIONS=1时对每次调用启用cProfile和tracemalloc，
+# 也可以在event中传入"debug_profile": true只分析单次调用
+PROFILE_INVOCATIONS = os.environ.get('PROFILE_INVOCATIONS', '').lower() in ('1', 'true', 'yes')
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', '15'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp')
+
+# 同一规则待查询的操作数达到该值时，改为按规则分页拉取关联到AssociationStore中查询
+STORE_DISCOVERY_THRESHOLD = int(os.environ.get('STORE_DISCOVERY_THRESHOLD', '50'))
+
 def lambda_handler(event, context):
     """
     Lambda函数处理Route53 Resolver规则与VPC的绑定/解绑操作
@@ -25,15 +73,138 @@ def lambda_handler(event, context):
     {
         "action": "associate" | "disassociate",
         "resolver_rule_id": "rslvr-rr-xxxxxxxxx",
-        "vpc_id": "vpc-xxxxxxxxx"
+        "vpc_id": "vpc-xxxxxxxxx",
+        "account_id": "123456789012"  // 可选，VPC所属账户，省略时使用Lambda自身凭证
+    }
+    
+    批量操作（剩余时间不足时返回continuation_token，带token再次调用即可续跑）:
+    {
+        "operations": [{"action": ..., "resolver_rule_id": ..., "vpc_id": ..., "account_id": ...}, ...],
+        "region": "us-west-2"
+    }
+    或
+    {
+        "continuation_token": "..."
+    }
+    
+    按域名冲突调度并发执行（同一VPC同一域名先解绑再绑定，其余操作全部并发）:
+    {
+        "schedule": {
+            "operations": [{"action": ..., "resolver_rule_id": ..., "vpc_id": ...}, ...],
+            "max_parallel": 16
+        },
+        "region": "us-west-2",
+        "account_id": "123456789012"
+    }
+    
+    分波次金丝雀切换（先切换canary_percent的VPC，健康检查通过后按growth_factor逐波扩大）:
+    {
+        "rollout": {
+            "from_rule_id": "rslvr-rr-forward",
+            "to_rule_id": "rslvr-rr-system",
+            "vpc_ids": ["vpc-aaa", "vpc-bbb", ...],
+            "canary_percent": 10,
+            "growth_factor": 2,
+            "max_parallel": 10,
+            "bake_seconds": 30,
+            "health_alarm_names": ["dns-resolution-errors"]
+        },
+        "region": "us-west-2",
+        "account_id": "123456789012"
     }
+    
+    SQS批量消息（每条消息body为上面的单个操作，或EventBridge事件，操作放在detail中）
+    按VPC分组并发处理，返回batchItemFailures，只有失败的消息会被重新投递
+    
+    以上格式都可以带"idempotency_key"，相同的key在IDEMPOTENCY_TTL_SECONDS内直接返回
+    第一次成功的结果，不再调用任何AWS接口
+    
+    带"debug_profile": true（或设置环境变量PROFILE_INVOCATIONS=1）时对本次调用进行性能分析
     """
     
+    if PROFILE_INVOCATIONS or event.get('debug_profile'):
+        return _run_profiled(_process_event, event, context)
+    return _process_event(event, context)
+
+
+def _process_event(event, context):
+    """
+    按event类型分发处理
+    """
+    if 'Records' in event:
+        return process_records(event, context)
+    
+    # EventBridge直接触发时操作放在detail中
+    if 'detail-type' in event and isinstance(event.get('detail'), dict):
+        event = event['detail']
+    
+    idempotency_key = event.get('idempotency_key')
+    if idempotency_key:
+        fingerprint = _request_fingerprint(event)
+        try:
+            cached = IDEMPOTENCY_CACHE.get(idempotency_key, fingerprint)
+        except ValueError as e:
+            logger.error(f"参数错误: {str(e)}")
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': '参数错误',
+                    'message': str(e)
+                }, ensure_ascii=False)
+            }
+        if cached is not None:
+            logger.info(f"幂等键 {idempotency_key} 命中缓存，直接返回之前的结果")
+            return cached
+        
+        # 先占用幂等键，同一请求的并发重试不会同时执行
+        if not IDEMPOTENCY_CACHE.acquire(idempotency_key, fingerprint):
+            cached = IDEMPOTENCY_CACHE.get(idempotency_key, fingerprint)
+            if cached is not None:
+                return cached
+            logger.warning(f"幂等键 {idempotency_key} 对应的请求正在处理中")
+            return {
+                'statusCode': 409,
+                'body': json.dumps({
+                    'error': '请求处理中',
+                    'message': f"幂等键 {idempotency_key} 对应的请求正在处理，请稍后重试"
+                }, ensure_ascii=False)
+            }
+    
+    try:
+        response = _handle_event(event, context)
+    except Exception:
+        if idempotency_key:
+            IDEMPOTENCY_CACHE.release(idempotency_key)
+        raise
+    
+    # 只缓存最终成功的结果，失败和未完成（202）的请求释放幂等键，允许重试
+    if idempotency_key:
+        if response['statusCode'] == 200:
+            IDEMPOTENCY_CACHE.put(idempotency_key, response, fingerprint)
+        else:
+            IDEMPOTENCY_CACHE.release(idempotency_key)
+    return response
+
+
+def _handle_event(event, context):
+    """
+    处理单个（非SQS）事件
+    """
     try:
+        if 'operations' in event or 'continuation_token' in event:
+            return run_batch_operations(event, context)
+        
+        if 'rollout' in event:
+            return _rollout_response(event, context)
+        
+        if 'schedule' in event:
+            return _schedule_response(event, context)
+        
         # 解析输入参数
         action = event.get('action')
         resolver_rule_id = event.get('resolver_rule_id')
         vpc_id = event.get('vpc_id')
+        account_id = event.get('account_id')
         
         # 参数验证
         if not all([action, resolver_rule_id, vpc_id]):
@@ -42,9 +213,12 @@ def lambda_handler(event, context):
         if action not in ['associate', 'disassociate']:
             raise ValueError("action必须是 'associate' 或 'disassociate'")
         
-        # 创建Route53 Resolver客户端（带重试配置）
+        if account_id is not None and not _is_valid_account_id(account_id):
+            raise ValueError(f"无效的account_id: {account_id}")
+        
+        # 获取Route53 Resolver客户端（带重试配置，指定account_id时使用该账户的角色凭证）
         region = event.get('region', 'us-west-2')  # 默认使用us-west-2
-        resolver_client = boto3.client('route53resolver', region_name=region, config=RETRY_CONFIG)
+        resolver_client = get_resolver_client(region, account_id)
         
         logger.info(f"开始执行操作: {action}, Resolver Rule ID: {resolver_rule_id}, VPC ID: {vpc_id}")
         
@@ -53,13 +227,7 @@ def lambda_handler(event, context):
         else:
             result = disassociate_resolver_rule(resolver_client, resolver_rule_id, vpc_id)
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'message': f'操作 {action} 成功完成',
-                'result': result
-            }, ensure_ascii=False)
-        }
+        return _operation_response(action, result)
         
     except ValueError as e:
         logger.error(f"参数错误: {str(e)}")
@@ -96,9 +264,24 @@ def lambda_handler(event, context):
         }
 
 
-def associate_resolver_rule(resolver_client, resolver_rule_id, vpc_id):
+def _operation_response(action, result):
+    """
+    单个绑定/解绑操作成功时的响应，直接调用和SQS消息使用相同的格式保存到幂等缓存
+    """
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': f'操作 {action} 成功完成',
+            'result': result
+        }, ensure_ascii=False)
+    }
+
+
+def associate_resolver_rule(resolver_client, resolver_rule_id, vpc_id, skip_lookup=False):
     """
     将Resolver规则与VPC关联
+    
+    skip_lookup为True时表示调用方已确认尚未关联，跳过关联查询
     """
     max_retries = 3
     retry_delay = 2  # 秒
@@ -106,25 +289,14 @@ def associate_resolver_rule(resolver_client, resolver_rule_id, vpc_id):
     for attempt in range(max_retries):
         try:
             # 检查是否已经关联
-            existing_associations = resolver_client.list_resolver_rule_associations(
-                Filters=[
-                    {
-                        'Name': 'ResolverRuleId',
-                        'Values': [resolver_rule_id]
-                    },
-                    {
-                        'Name': 'VPCId',
-                        'Values': [vpc_id]
+            if not skip_lookup:
+                existing = find_rule_association(resolver_client, resolver_rule_id, vpc_id)
+                if existing:
+                    logger.info(f"Resolver规则 {resolver_rule_id} 已经与VPC {vpc_id} 关联")
+                    return {
+                        'association_id': existing['Id'],
+                        'status': 'already_associated'
                     }
-                ]
-            )
-            
-            if existing_associations['ResolverRuleAssociations']:
-                logger.info(f"Resolver规则 {resolver_rule_id} 已经与VPC {vpc_id} 关联")
-                return {
-                    'association_id': existing_associations['ResolverRuleAssociations'][0]['Id'],
-                    'status': 'already_associated'
-                }
             
             # 创建新的关联
             response = resolver_client.associate_resolver_rule(
@@ -186,9 +358,11 @@ def associate_resolver_rule(resolver_client, resolver_rule_id, vpc_id):
     raise Exception("所有重试尝试都失败了")
 
 
-def disassociate_resolver_rule(resolver_client, resolver_rule_id, vpc_id):
+def disassociate_resolver_rule(resolver_client, resolver_rule_id, vpc_id, association_id=None):
     """
     解除Resolver规则与VPC的关联
+    
+    传入association_id时表示调用方已查到关联，跳过关联查询
     """
     max_retries = 3
     retry_delay = 2  # 秒
@@ -196,28 +370,16 @@ def disassociate_resolver_rule(resolver_client, resolver_rule_id, vpc_id):
     for attempt in range(max_retries):
         try:
             # 查找现有关联
-            associations = resolver_client.list_resolver_rule_associations(
-                Filters=[
-                    {
-                        'Name': 'ResolverRuleId',
-                        'Values': [resolver_rule_id]
-                    },
-                    {
-                        'Name': 'VPCId',
-                        'Values': [vpc_id]
+            if association_id is None:
+                existing = find_rule_association(resolver_client, resolver_rule_id, vpc_id)
+                if not existing:
+                    logger.info(f"未找到Resolver规则 {resolver_rule_id} 与VPC {vpc_id} 的关联")
+                    return {
+                        'status': 'not_associated'
                     }
-                ]
-            )
-            
-            if not associations['ResolverRuleAssociations']:
-                logger.info(f"未找到Resolver规则 {resolver_rule_id} 与VPC {vpc_id} 的关联")
-                return {
-                    'status': 'not_associated'
-                }
+                association_id = existing['Id']
             
             # 解除关联
-            association_id = associations['ResolverRuleAssociations'][0]['Id']
-            
             response = resolver_client.disassociate_resolver_rule(
                 VPCId=vpc_id,
                 ResolverRuleId=resolver_rule_id
@@ -264,6 +426,79 @@ def disassociate_resolver_rule(resolver_client, resolver_rule_id, vpc_id):
     raise Exception("所有重试尝试都失败了")
 
 
+def wait_for_association(resolver_client, association_id, timeout=ASSOCIATION_WAIT_TIMEOUT):
+    """
+    等待关联创建完成，状态变为COMPLETE时返回True，FAILED或超时返回False
+    """
+    deadline = time.time() + timeout
+    while True:
+        association = resolver_client.get_resolver_rule_association(
+            ResolverRuleAssociationId=association_id
+        )['ResolverRuleAssociation']
+        
+        if association['Status'] == 'COMPLETE':
+            return True
+        if association['Status'] == 'FAILED':
+            logger.error(f"关联 {association_id} 创建失败: {association.get('StatusMessage', '')}")
+            return False
+        if time.time() >= deadline:
+            logger.error(f"等待关联 {association_id} 创建超时，当前状态: {association['Status']}")
+            return False
+        time.sleep(ASSOCIATION_POLL_INTERVAL)
+
+
+def wait_for_disassociation(resolver_client, association_id, timeout=ASSOCIATION_WAIT_TIMEOUT):
+    """
+    等待关联删除完成（查询返回ResourceNotFoundException）
+    
+    同域名的两条规则不能同时绑定同一个VPC，必须等解绑真正完成后才能绑定另一条
+    """
+    deadline = time.time() + timeout
+    while True:
+        association = _get_association_if_exists(resolver_client, association_id)
+        if association is None:
+            return True
+        
+        if time.time() >= deadline:
+            logger.error(f"等待关联 {association_id} 删除超时，当前状态: {association['Status']}")
+            return False
+        time.sleep(ASSOCIATION_POLL_INTERVAL)
+
+
+def _get_association_if_exists(resolver_client, association_id):
+    """
+    查询一次关联，已删除（ResourceNotFoundException）时返回None
+    """
+    try:
+        return resolver_client.get_resolver_rule_association(
+            ResolverRuleAssociationId=association_id
+        )['ResolverRuleAssociation']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            return None
+        raise
+
+
+def find_rule_association(resolver_client, resolver_rule_id, vpc_id):
+    """
+    查询Resolver规则与VPC的现有关联，不存在时返回None
+    """
+    response = resolver_client.list_resolver_rule_associations(
+        Filters=[
+            {
+                'Name': 'ResolverRuleId',
+                'Values': [resolver_rule_id]
+            },
+            {
+                'Name': 'VPCId',
+                'Values': [vpc_id]
+            }
+        ]
+    )
+    associations = response['ResolverRuleAssociations']
+    return associations[0] if associations else None
+
+
 def get_resolver_rule_info(resolver_client, resolver_rule_id):
     """
     获取Resolver规则信息（辅助函数）
@@ -293,3 +528,1923 @@ def list_vpc_associations(resolver_client, resolver_rule_id):
         return response['ResolverRuleAssociations']
     except ClientError:
         return []
+
+
+# ==================== 批量操作（断点续跑） ====================
+
+def run_batch_operations(event, context):
+    """
+    以检查点状态机执行批量绑定/解绑操作
+    
+    状态机分为 discover（查询现有关联）和 execute（执行变更）两个阶段，
+    每个操作的查询结果和执行结果都记录在状态中。剩余时间不足时把状态编码为
+    continuation_token返回，续跑时直接从未完成的操作开始，不会重复查询或重复变更。
+    """
+    if event.get('continuation_token'):
+        state = decode_continuation_token(event['continuation_token'])
+        if state.get('mode') == 'rollout':
+            raise ValueError("分波次切换的continuation_token请放在rollout.continuation_token中")
+        logger.info(f"从检查点恢复: 阶段 {state['phase']}, 共 {len(state['operations'])} 个操作")
+    else:
+        state = new_batch_state(event.get('operations'), event.get('region', 'us-west-2'))
+        logger.info(f"开始批量操作: 共 {len(state['operations'])} 个操作")
+    
+    if state['phase'] == 'discover':
+        if not _run_per_account(state, context, _discover_operations):
+            return _checkpoint_response(state)
+        state['phase'] = 'execute'
+    
+    if state['phase'] == 'execute':
+        if not _run_per_account(state, context, _execute_operations):
+            return _checkpoint_response(state)
+        state['phase'] = 'done'
+    
+    return _batch_result_response(state)
+
+
+def new_batch_state(operations, region):
+    """
+    校验批量操作参数并生成初始状态
+    """
+    if not operations or not isinstance(operations, list):
+        raise ValueError("operations必须是非空列表")
+    
+    state_operations = []
+    for index, operation in enumerate(operations):
+        action = operation.get('action')
+        resolver_rule_id = operation.get('resolver_rule_id')
+        vpc_id = operation.get('vpc_id')
+        account_id = operation.get('account_id')
+        
+        if not all([action, resolver_rule_id, vpc_id]):
+            raise ValueError(f"第 {index} 个操作缺少必需参数: action, resolver_rule_id, vpc_id")
+        if action not in ['associate', 'disassociate']:
+            raise ValueError(f"第 {index} 个操作的action必须是 'associate' 或 'disassociate'")
+        if account_id is not None and not _is_valid_account_id(account_id):
+            raise ValueError(f"第 {index} 个操作的account_id无效: {account_id}")
+        
+        state_operations.append({
+            'action': action,
+            'resolver_rule_id': resolver_rule_id,
+            'vpc_id': vpc_id,
+            'account_id': account_id,
+            'discovered': False,
+            'association_id': None,
+            'result': None
+        })
+    
+    return {
+        'version': CHECKPOINT_VERSION,
+        'phase': 'discover',
+        'region': region,
+        'operations': state_operations
+    }
+
+
+def encode_continuation_token(state):
+    """
+    将状态压缩编码为continuation_token
+    
+    已完成的操作只保留结果，不再保存discover阶段的查询结果。编码后超过
+    CHECKPOINT_INLINE_BYTES且配置了持久化后端时，状态保存到后端，token只包含引用
+    """
+    compact = dict(state)
+    if 'operations' in state:
+        compact['operations'] = [
+            {key: value for key, value in operation.items() if key not in ('discovered', 'association_id')}
+            if operation['result'] is not None else operation
+            for operation in state['operations']
+        ]
+    raw = json.dumps(compact, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    token = base64.urlsafe_b64encode(zlib.compress(raw, 9)).decode('ascii')
+    
+    if len(token) > CHECKPOINT_INLINE_BYTES and CHECKPOINT_STORE is not None:
+        key = f"checkpoint:{hashlib.sha256(raw).hexdigest()}"
+        CHECKPOINT_STORE.put(key, token, time.time() + CHECKPOINT_TTL_SECONDS)
+        logger.info(f"检查点状态 {len(token)} 字节，已保存到持久化后端")
+        return f"{CHECKPOINT_REFERENCE_PREFIX}{key}"
+    if len(token) > CHECKPOINT_INLINE_BYTES:
+        logger.warning(f"continuation_token为 {len(token)} 字节，可能超过调用方的载荷限制，"
+                       f"建议配置IDEMPOTENCY_TABLE或IDEMPOTENCY_DIR")
+    return token
+
+
+def decode_continuation_token(token):
+    """
+    解码continuation_token，格式无效时抛出ValueError
+    """
+    if isinstance(token, str) and token.startswith(CHECKPOINT_REFERENCE_PREFIX):
+        item = CHECKPOINT_STORE.get(token[len(CHECKPOINT_REFERENCE_PREFIX):]) if CHECKPOINT_STORE else None
+        if item is None:
+            raise ValueError("continuation_token已过期或不存在")
+        token = item['response']
+    
+    try:
+        state = json.loads(zlib.decompress(base64.urlsafe_b64decode(token.encode('ascii'))))
+    except Exception:
+        raise ValueError("无效的continuation_token")
+    
+    if not isinstance(state, dict) or state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError("continuation_token版本不匹配")
+    for operation in state.get('operations', []):
+        operation.setdefault('discovered', True)
+        operation.setdefault('association_id', None)
+    return state
+
+
+def _time_is_running_out(context):
+    """
+    判断Lambda剩余执行时间是否已低于检查点阈值（本地调用时没有context，视为时间充足）
+    """
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        return False
+    return get_remaining() < CHECKPOINT_MARGIN_MS
+
+
+def _wait_budget(context, timeout=ASSOCIATION_WAIT_TIMEOUT):
+    """
+    本次调用中最多可以等待的秒数：不超过timeout，也不超过剩余执行时间减去检查点阈值
+    """
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        return timeout
+    return max(0, min(timeout, (get_remaining() - CHECKPOINT_MARGIN_MS) / 1000))
+
+
+def _run_per_account(state, context, worker):
+    """
+    按账户分组并发执行worker，同一账户内的操作保持原有顺序串行执行
+    
+    worker(resolver_client, state, indexes, context) 返回False表示时间不足提前停止，
+    任一账户提前停止时整体返回False
+    """
+    groups = {}
+    for index, operation in enumerate(state['operations']):
+        groups.setdefault(operation.get('account_id'), []).append(index)
+    
+    def run_group(account_id, indexes):
+        try:
+            resolver_client = get_resolver_client(state['region'], account_id)
+        except (ClientError, BotoCoreError) as e:
+            # 无法获取该账户的凭证（AssumeRole被拒绝，或STS端点无法连接），该账户下未完成的操作全部记为失败
+            logger.error(f"无法获取账户 {account_id} 的凭证: {str(e)}")
+            for index in indexes:
+                operation = state['operations'][index]
+                if operation['result'] is None:
+                    operation['discovered'] = True
+                    operation['result'] = _failure_result(e)
+            return True
+        return worker(resolver_client, state, indexes, context)
+    
+    if len(groups) == 1:
+        return all(run_group(account_id, indexes) for account_id, indexes in groups.items())
+    
+    with _ProfiledThreadPoolExecutor(max_workers=min(MAX_ACCOUNT_WORKERS, len(groups))) as executor:
+        futures = [executor.submit(run_group, account_id, indexes) for account_id, indexes in groups.items()]
+        return all([future.result() for future in futures])
+
+
+def _discover_operations(resolver_client, state, indexes, context):
+    """
+    查询每个操作对应的现有关联，时间不足时返回False
+    
+    同一规则待查询的操作数达到STORE_DISCOVERY_THRESHOLD时，先尝试按规则分页加载关联，
+    加载失败或分页数超过待查询数时退回逐个查询
+    """
+    pending = {}
+    for index in indexes:
+        operation = state['operations'][index]
+        if not operation['discovered']:
+            pending.setdefault(operation['resolver_rule_id'], []).append(index)
+    
+    for resolver_rule_id, rule_indexes in pending.items():
+        if (len(rule_indexes) >= STORE_DISCOVERY_THRESHOLD
+                and _discover_operations_from_store(resolver_client, state, resolver_rule_id, rule_indexes, context)):
+            continue
+        
+        for index in rule_indexes:
+            operation = state['operations'][index]
+            if _time_is_running_out(context):
+                return False
+            
+            try:
+                existing = find_rule_association(resolver_client, resolver_rule_id, operation['vpc_id'])
+                operation['association_id'] = existing['Id'] if existing else None
+            except ClientError as e:
+                # 查询失败的操作直接记录失败结果，执行阶段不再处理
+                operation['result'] = _failure_result(e)
+            operation['discovered'] = True
+    
+    return True
+
+
+def _discover_operations_from_store(resolver_client, state, resolver_rule_id, indexes, context):
+    """
+    分页加载规则的全部关联后在内存中查询，避免逐个操作调用list接口
+    
+    分页数不超过待查询的操作数，返回False表示未加载完成（分页过多、时间不足或调用失败），
+    由调用方逐个查询
+    """
+    filters = [{'Name': 'ResolverRuleId', 'Values': [resolver_rule_id]}]
+    try:
+        store = load_association_store(resolver_client, filters, context=context, max_pages=len(indexes))
+    except ClientError as e:
+        logger.warning(f"按规则 {resolver_rule_id} 加载关联失败，改为逐个查询: {str(e)}")
+        return False
+    if store is None:
+        return False
+    
+    for index in indexes:
+        operation = state['operations'][index]
+        existing = store.find(resolver_rule_id, operation['vpc_id'])
+        operation['association_id'] = existing['Id'] if existing else None
+        operation['discovered'] = True
+    
+    return True
+
+
+def _execute_operations(resolver_client, state, indexes, context):
+    """
+    按查询结果执行绑定/解绑，时间不足时返回False
+    
+    同一规则与VPC在批次中可能被多次操作，此时以前面最近一次成功操作的结果为准，否则使用
+    discover阶段查到的关联。绑定前先等待同一VPC上更早的解绑真正完成，否则同域名的规则
+    会绑定失败；等待时间不超过剩余执行时间，来不及完成时保存检查点，下次调用继续等待。
+    """
+    # 本次调用中按顺序维护的索引，避免每个操作回扫前面的所有操作
+    latest = {}      # (vpc_id, resolver_rule_id) -> 最近一次成功操作后的关联ID（已解绑为None）
+    unsettled = {}   # vpc_id -> 已解绑但本次调用尚未确认删除完成的关联ID
+    
+    for index in indexes:
+        operation = state['operations'][index]
+        resolver_rule_id = operation['resolver_rule_id']
+        vpc_id = operation['vpc_id']
+        key = (vpc_id, resolver_rule_id)
+        
+        if operation['result'] is None:
+            if _time_is_running_out(context):
+                return False
+            
+            association_id = latest[key] if key in latest else operation['association_id']
+            try:
+                if operation['action'] == 'associate':
+                    if association_id:
+                        logger.info(f"Resolver规则 {resolver_rule_id} 已经与VPC {vpc_id} 关联")
+                        result = {'association_id': association_id, 'status': 'already_associated'}
+                    else:
+                        if not _settle_disassociations(resolver_client, unsettled.get(vpc_id, []), context):
+                            return False
+                        result = associate_resolver_rule(resolver_client, resolver_rule_id, vpc_id, skip_lookup=True)
+                else:
+                    if association_id:
+                        result = disassociate_resolver_rule(resolver_client, resolver_rule_id, vpc_id,
+                                                            association_id=association_id)
+                    else:
+                        logger.info(f"未找到Resolver规则 {resolver_rule_id} 与VPC {vpc_id} 的关联")
+                        result = {'status': 'not_associated'}
+            except ClientError as e:
+                result = _failure_result(e)
+            
+            operation['result'] = result
+        
+        result = operation['result']
+        if result['status'] in ('associated', 'already_associated'):
+            latest[key] = result.get('association_id')
+        elif result['status'] in ('disassociated', 'not_associated'):
+            latest[key] = None
+        if result['status'] == 'disassociated' and result.get('association_id'):
+            unsettled.setdefault(vpc_id, []).append(result['association_id'])
+    
+    return True
+
+
+def _settle_disassociations(resolver_client, association_ids, context):
+    """
+    依次等待association_ids中的解绑完成，已确认的从列表中移除
+    
+    剩余执行时间不足以继续等待时返回False；等待满ASSOCIATION_WAIT_TIMEOUT仍未完成时
+    只记录告警，由后续的绑定调用报告冲突
+    """
+    while association_ids:
+        association_id = association_ids[0]
+        settled = _wait_within_budget(wait_for_disassociation, resolver_client, association_id, context)
+        if settled is None:
+            return False
+        if not settled:
+            logger.warning(f"关联 {association_id} 尚未删除完成，继续尝试绑定")
+        association_ids.pop(0)
+    return True
+
+
+def _failure_result(error):
+    """
+    将AWS API错误转换为单个操作的失败结果
+    
+    BotoCoreError（如端点无法连接）没有错误响应，使用异常类名作为错误码
+    """
+    if not isinstance(error, ClientError):
+        return {'status': 'failed', 'code': type(error).__name__, 'message': str(error)}
+    return {
+        'status': 'failed',
+        'code': error.response['Error']['Code'],
+        'message': error.response['Error']['Message']
+    }
+
+
+def _checkpoint_response(state):
+    """
+    剩余时间不足时返回进度和continuation_token
+    """
+    completed = sum(1 for operation in state['operations'] if operation['result'] is not None)
+    logger.info(f"剩余时间不足，保存检查点: 阶段 {state['phase']}, 已完成 {completed}/{len(state['operations'])}")
+    
+    return {
+        'statusCode': 202,
+        'body': json.dumps({
+            'message': '操作未全部完成，请携带continuation_token再次调用',
+            'phase': state['phase'],
+            'completed': completed,
+            'total': len(state['operations']),
+            'continuation_token': encode_continuation_token(state)
+        }, ensure_ascii=False)
+    }
+
+
+def _batch_result_response(state):
+    """
+    批量操作全部结束后的响应，存在失败操作时返回500
+    """
+    results = []
+    for operation in state['operations']:
+        results.append({
+            'action': operation['action'],
+            'resolver_rule_id': operation['resolver_rule_id'],
+            'vpc_id': operation['vpc_id'],
+            'account_id': operation['account_id'],
+            **operation['result']
+        })
+    failed = [result for result in results if result['status'] == 'failed']
+    
+    if failed:
+        logger.error(f"批量操作完成，{len(failed)}/{len(results)} 个操作失败")
+    else:
+        logger.info(f"批量操作全部成功完成: 共 {len(results)} 个操作")
+    
+    return {
+        'statusCode': 500 if failed else 200,
+        'body': json.dumps({
+            'message': '部分操作失败' if failed else '批量操作成功完成',
+            'total': len(results),
+            'failed': len(failed),
+            'results': results
+        }, ensure_ascii=False)
+    }
+
+
+# ==================== 多账户凭证 ====================
+
+class AssumedRoleCredentialCache:
+    """
+    按账户缓存AssumeRole得到的临时凭证
+    
+    凭证在距离过期不足refresh_margin_seconds前一直复用；进入background_refresh_seconds
+    窗口后仍返回缓存凭证，同时在后台线程中提前刷新，避免请求路径上等待STS。
+    sts_client可以替换为本地的STS替身（只需实现assume_role），便于离线测试。
+    """
+    
+    def __init__(self, sts_client=None, role_name=CROSS_ACCOUNT_ROLE_NAME,
+                 session_name='route53-resolver-manager', duration_seconds=3600,
+                 refresh_margin_seconds=300, background_refresh_seconds=900, clock=time.time):
+        self._sts_client = sts_client
+        self._role_name = role_name
+        self._session_name = session_name
+        self._duration_seconds = duration_seconds
+        self._refresh_margin_seconds = refresh_margin_seconds
+        self._background_refresh_seconds = background_refresh_seconds
+        self._clock = clock
+        
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._account_locks = {}
+        self._refreshing = set()
+        self._executor = None
+    
+    def get_credentials(self, account_id):
+        """
+        返回账户的临时凭证字典（access_key_id、secret_access_key、session_token、expiration）
+        """
+        with self._lock:
+            entry = self._entries.get(account_id)
+        
+        if entry is not None:
+            remaining = entry['expiration'] - self._clock()
+            if remaining > self._refresh_margin_seconds:
+                if remaining <= self._background_refresh_seconds:
+                    self._schedule_refresh(account_id)
+                return entry
+        
+        # 缓存缺失或即将过期，同步获取；同一账户同一时间只有一个线程调用STS
+        with self._account_lock(account_id):
+            with self._lock:
+                entry = self._entries.get(account_id)
+            if entry is not None and entry['expiration'] - self._clock() > self._refresh_margin_seconds:
+                return entry
+            return self._assume_role(account_id)
+    
+    def invalidate(self, account_id=None):
+        """
+        清除指定账户（或全部账户）的缓存凭证
+        """
+        with self._lock:
+            if account_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(account_id, None)
+    
+    def _account_lock(self, account_id):
+        with self._lock:
+            return self._account_locks.setdefault(account_id, threading.Lock())
+    
+    def _get_sts_client(self):
+        if self._sts_client is None:
+            # STS_ENDPOINT_URL可指向本地STS替身
+            endpoint_url = os.environ.get('STS_ENDPOINT_URL')
+            self._sts_client = boto3.client('sts', endpoint_url=endpoint_url, config=RETRY_CONFIG)
+        return self._sts_client
+    
+    def _assume_role(self, account_id):
+        role_arn = f"arn:aws:iam::{account_id}:role/{self._role_name}"
+        logger.info(f"扮演角色: {role_arn}")
+        
+        response = self._get_sts_client().assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=self._session_name,
+            DurationSeconds=self._duration_seconds
+        )
+        credentials = response['Credentials']
+        expiration = credentials['Expiration']
+        
+        entry = {
+            'access_key_id': credentials['AccessKeyId'],
+            'secret_access_key': credentials['SecretAccessKey'],
+            'session_token': credentials['SessionToken'],
+            # boto3返回datetime，STS替身也可以直接返回时间戳
+            'expiration': expiration.timestamp() if hasattr(expiration, 'timestamp') else float(expiration)
+        }
+        with self._lock:
+            self._entries[account_id] = entry
+        return entry
+    
+    def _schedule_refresh(self, account_id):
+        with self._lock:
+            if account_id in self._refreshing:
+                return
+            self._refreshing.add(account_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='credential-refresh')
+        self._executor.submit(self._background_refresh, account_id)
+    
+    def _background_refresh(self, account_id):
+        try:
+            with self._account_lock(account_id):
+                self._assume_role(account_id)
+        except Exception as e:
+            # 后台刷新失败不影响当前凭证，到期前的同步路径会再次尝试
+            logger.warning(f"后台刷新账户 {account_id} 凭证失败: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(account_id)
+
+
+# 容器生命周期内共享的凭证缓存，测试时可替换为使用STS替身的实例
+CREDENTIAL_CACHE = AssumedRoleCredentialCache()
+
+_client_lock = threading.Lock()
+_resolver_clients = {}
+
+
+def get_resolver_client(region, account_id=None):
+    """
+    获取Route53 Resolver客户端
+    
+    未指定account_id时使用Lambda自身凭证；指定时使用该账户的角色凭证。
+    客户端按(account_id, region)缓存，凭证刷新后自动重建
+    """
+    credentials = CREDENTIAL_CACHE.get_credentials(account_id) if account_id else None
+    expiration = credentials['expiration'] if credentials else None
+    key = (account_id, region)
+    
+    with _client_lock:
+        cached = _resolver_clients.get(key)
+        if cached is not None and cached[0] == expiration:
+            return cached[1]
+        
+        if credentials:
+            session = boto3.Session(
+                aws_access_key_id=credentials['access_key_id'],
+                aws_secret_access_key=credentials['secret_access_key'],
+                aws_session_token=credentials['session_token']
+            )
+        else:
+            session = boto3.Session()
+        resolver_client = session.client('route53resolver', region_name=region, config=RETRY_CONFIG)
+        _resolver_clients[key] = (expiration, resolver_client)
+        return resolver_client
+
+
+def _is_valid_account_id(account_id):
+    """
+    校验AWS账户ID格式（12位数字）
+    """
+    return isinstance(account_id, str) and bool(re.match(r'^\d{12}$', account_id))
+
+
+# ==================== 关联清单的紧凑存储 ====================
+
+class AssociationStore:
+    """
+    大规模规则-VPC关联清单的紧凑内存表示
+    
+    规则ID和VPC ID被驻留为整数句柄，关联ID按十六进制后缀解析为整数，关联记录按列
+    保存在array中，并维护按规则和按VPC的二级索引。相比保存
+    list_resolver_rule_associations返回的原始字典，内存占用大幅降低，按规则或VPC
+    查询只需访问该规则/VPC自己的关联。
+    """
+    
+    STATUSES = ('CREATING', 'COMPLETE', 'DELETING', 'FAILED', 'OVERRIDDEN')
+    ASSOCIATION_ID_PREFIX = 'rslvr-rrassoc-'
+    ASSOCIATION_ID_PATTERN = re.compile(r'^rslvr-rrassoc-([0-9a-f]{17})$')
+    
+    __slots__ = ('_rule_ids', '_rule_handles', '_vpc_ids', '_vpc_handles',
+                 '_id_low', '_id_high', '_irregular_ids', '_rules', '_vpcs', '_statuses',
+                 '_by_rule', '_by_vpc')
+    
+    def __init__(self):
+        self._rule_ids = []
+        self._rule_handles = {}
+        self._vpc_ids = []
+        self._vpc_handles = {}
+        
+        # 每条关联一行，按列存储；关联ID的17位十六进制后缀拆成低64位和高4位，
+        # 不符合该格式的关联ID单独保存
+        self._id_low = array('Q')
+        self._id_high = array('B')
+        self._irregular_ids = {}
+        self._rules = array('i')
+        self._vpcs = array('i')
+        self._statuses = array('b')
+        
+        # 二级索引：句柄 -> 行号数组
+        self._by_rule = {}
+        self._by_vpc = {}
+    
+    def __len__(self):
+        return len(self._rules)
+    
+    def add(self, association):
+        """
+        添加一条list_resolver_rule_associations返回格式的关联
+        """
+        rule = self._intern(association['ResolverRuleId'], self._rule_ids, self._rule_handles)
+        vpc = self._intern(association['VPCId'], self._vpc_ids, self._vpc_handles)
+        status = association.get('Status', 'COMPLETE')
+        row = len(self._rules)
+        
+        match = self.ASSOCIATION_ID_PATTERN.match(association['Id'])
+        if match:
+            value = int(match.group(1), 16)
+            self._id_low.append(value & 0xFFFFFFFFFFFFFFFF)
+            self._id_high.append(value >> 64)
+        else:
+            self._id_low.append(0)
+            self._id_high.append(0)
+            self._irregular_ids[row] = association['Id']
+        
+        self._rules.append(rule)
+        self._vpcs.append(vpc)
+        self._statuses.append(self.STATUSES.index(status) if status in self.STATUSES else -1)
+        
+        self._by_rule.setdefault(rule, array('i')).append(row)
+        self._by_vpc.setdefault(vpc, array('i')).append(row)
+    
+    def find(self, resolver_rule_id, vpc_id):
+        """
+        查询规则与VPC的关联，返回与find_rule_association相同格式的字典，不存在时返回None
+        """
+        rule = self._rule_handles.get(resolver_rule_id)
+        vpc = self._vpc_handles.get(vpc_id)
+        if rule is None or vpc is None:
+            return None
+        
+        # 单个VPC关联的规则数很少，在VPC索引中查找
+        rules = self._rules
+        for row in self._by_vpc[vpc]:
+            if rules[row] == rule:
+                return self._record(row)
+        return None
+    
+    def associations_for_rule(self, resolver_rule_id):
+        """
+        列出规则的全部VPC关联
+        """
+        rule = self._rule_handles.get(resolver_rule_id)
+        return [self._record(row) for row in self._by_rule.get(rule, ())]
+    
+    def associations_for_vpc(self, vpc_id):
+        """
+        列出VPC的全部规则关联
+        """
+        vpc = self._vpc_handles.get(vpc_id)
+        return [self._record(row) for row in self._by_vpc.get(vpc, ())]
+    
+    def vpc_ids_for_rule(self, resolver_rule_id):
+        """
+        列出与规则关联的VPC ID
+        """
+        rule = self._rule_handles.get(resolver_rule_id)
+        return [self._vpc_ids[self._vpcs[row]] for row in self._by_rule.get(rule, ())]
+    
+    def rule_ids_for_vpc(self, vpc_id):
+        """
+        列出与VPC关联的规则ID
+        """
+        vpc = self._vpc_handles.get(vpc_id)
+        return [self._rule_ids[self._rules[row]] for row in self._by_vpc.get(vpc, ())]
+    
+    @staticmethod
+    def _intern(value, values, handles):
+        handle = handles.get(value)
+        if handle is None:
+            handle = len(values)
+            values.append(value)
+            handles[value] = handle
+        return handle
+    
+    def _association_id(self, row):
+        irregular = self._irregular_ids.get(row)
+        if irregular is not None:
+            return irregular
+        value = (self._id_high[row] << 64) | self._id_low[row]
+        return f"{self.ASSOCIATION_ID_PREFIX}{value:017x}"
+    
+    def _record(self, row):
+        status = self._statuses[row]
+        return {
+            'Id': self._association_id(row),
+            'ResolverRuleId': self._rule_ids[self._rules[row]],
+            'VPCId': self._vpc_ids[self._vpcs[row]],
+            'Status': self.STATUSES[status] if status >= 0 else 'UNKNOWN'
+        }
+
+
+def load_association_store(resolver_client, filters=None, context=None, max_pages=None):
+    """
+    分页拉取关联清单并逐页写入AssociationStore，不保留原始分页数据
+    
+    每页之间检查剩余执行时间，时间不足或分页数超过max_pages时放弃加载并返回None
+    """
+    store = AssociationStore()
+    paginator = resolver_client.get_paginator('list_resolver_rule_associations')
+    kwargs = {'Filters': filters} if filters else {}
+    
+    for page_count, page in enumerate(paginator.paginate(**kwargs), start=1):
+        for association in page['ResolverRuleAssociations']:
+            store.add(association)
+        if not page.get('NextToken'):
+            break
+        if (max_pages is not None and page_count >= max_pages) or _time_is_running_out(context):
+            logger.info(f"放弃加载关联清单: 已加载 {page_count} 页")
+            return None
+    
+    logger.info(f"已加载 {len(store)} 条关联")
+    return store
+
+
+# ==================== 分波次金丝雀切换 ====================
+
+def plan_waves(total, canary_percent=10, growth_factor=2):
+    """
+    计算每一波的数量：第一波为canary_percent（至少1个），之后每波按growth_factor扩大
+    """
+    if total <= 0:
+        return []
+    
+    sizes = []
+    size = max(1, math.ceil(total * canary_percent / 100))
+    remaining = total
+    while remaining > 0:
+        size = min(size, remaining)
+        sizes.append(size)
+        remaining -= size
+        size = max(size + 1, math.ceil(size * growth_factor))
+    return sizes
+
+
+def new_rollout_state(from_rule_id, to_rule_id, vpc_ids, region, account_id=None, canary_percent=10,
+                      growth_factor=2, max_parallel=10, bake_seconds=0, health_alarm_names=None):
+    """
+    校验分波次切换参数并生成初始状态
+    """
+    if not vpc_ids:
+        raise ValueError("vpc_ids必须是非空列表")
+    if not 0 < canary_percent <= 100:
+        raise ValueError("canary_percent必须在(0, 100]之间")
+    if growth_factor < 1:
+        raise ValueError("growth_factor不能小于1")
+    
+    waves = plan_waves(len(vpc_ids), canary_percent, growth_factor)
+    return {
+        'version': CHECKPOINT_VERSION,
+        'mode': 'rollout',
+        'phase': 'switch',
+        'region': region,
+        'account_id': account_id,
+        'from_rule_id': from_rule_id,
+        'to_rule_id': to_rule_id,
+        'vpc_ids': list(vpc_ids),
+        'waves': waves,
+        'max_parallel': max_parallel,
+        'bake_seconds': bake_seconds,
+        'health_alarm_names': health_alarm_names or [],
+        'wave_index': 0,
+        'wave_results': [None] * waves[0],
+        'bake_until': None,
+        'touched_results': [],
+        'rollback_results': None,
+        'report': {'status': 'in_progress', 'waves': [], 'rolled_back': []}
+    }
+
+
+def rollout_rule_switch(resolver_client, state, context=None, cloudwatch_client=None):
+    """
+    按波次把VPC从from_rule切换到to_rule，任一波失败时停止并回滚所有已切换的VPC
+    
+    每个VPC先解绑from_rule并等待解绑完成，再绑定to_rule并等待关联生效；同一波内的VPC
+    以max_parallel个一批并发切换。每波结束后等待bake_seconds，再检查本波结果和
+    health_alarm_names中的CloudWatch告警，健康时才继续下一波。
+    
+    切换、观察和回滚的进度都记录在state中，剩余时间不足时返回False，调用方保存state后
+    下次调用继续；全部结束时返回True，结果在state['report']中。
+    """
+    from_rule_id = state['from_rule_id']
+    to_rule_id = state['to_rule_id']
+    report = state['report']
+    
+    while state['phase'] in ('switch', 'bake'):
+        wave_number = state['wave_index'] + 1
+        start = sum(state['waves'][:state['wave_index']])
+        wave_vpc_ids = state['vpc_ids'][start:start + state['waves'][state['wave_index']]]
+        
+        if state['phase'] == 'switch':
+            if not _run_resumable(
+                lambda vpc_id, progress: _switch_vpc(resolver_client, from_rule_id, to_rule_id, vpc_id,
+                                                     context, progress),
+                wave_vpc_ids, state['wave_results'], state['max_parallel'], context
+            ):
+                return False
+            # 切换失败的VPC可能已解绑from_rule，回滚时同样需要恢复
+            state['touched_results'].extend(state['wave_results'])
+            if state['bake_seconds'] and all(result['status'] == 'switched' for result in state['wave_results']):
+                logger.info(f"第 {wave_number} 波切换完成，观察 {state['bake_seconds']} 秒")
+                state['bake_until'] = time.time() + state['bake_seconds']
+            state['phase'] = 'bake'
+        
+        if not _bake(state, context):
+            return False
+        
+        results = state['wave_results']
+        healthy, reason = _wave_is_healthy(results, state['health_alarm_names'], cloudwatch_client)
+        report['waves'].append({
+            'wave': wave_number,
+            'vpc_ids': wave_vpc_ids,
+            'healthy': healthy,
+            'results': results
+        })
+        
+        if not healthy:
+            logger.error(f"第 {wave_number} 波健康检查失败: {reason}，"
+                         f"停止切换并回滚 {len(state['touched_results'])} 个VPC")
+            report['reason'] = reason
+            state['phase'] = 'rollback'
+            state['rollback_results'] = [None] * len(state['touched_results'])
+            break
+        
+        logger.info(f"第 {wave_number}/{len(state['waves'])} 波健康，"
+                    f"已切换 {len(state['touched_results'])}/{len(state['vpc_ids'])} 个VPC")
+        state['wave_index'] += 1
+        state['bake_until'] = None
+        if state['wave_index'] == len(state['waves']):
+            state['phase'] = 'done'
+            report['status'] = 'completed'
+        else:
+            state['phase'] = 'switch'
+            state['wave_results'] = [None] * state['waves'][state['wave_index']]
+    
+    if state['phase'] == 'rollback':
+        if not _run_resumable(
+            lambda result, progress: _restore_vpc(resolver_client, from_rule_id, to_rule_id, result,
+                                                  context, progress),
+            list(reversed(state['touched_results'])), state['rollback_results'], state['max_parallel'], context
+        ):
+            return False
+        report['status'] = 'rolled_back'
+        report['rolled_back'] = state['rollback_results']
+        state['phase'] = 'done'
+    
+    return True
+
+
+def _run_resumable(func, items, results, max_parallel, context):
+    """
+    分批并发执行func(item, progress)，结果写回results中对应的位置
+    
+    results中为None或状态为pending的项尚未完成，progress为该项上次保存的进度。每批最多
+    max_parallel个，开始前检查剩余时间；时间不足或本批有项需要下次调用继续时返回False
+    """
+    while True:
+        todo = [index for index, result in enumerate(results) if result is None or result['status'] == 'pending']
+        if not todo:
+            return True
+        if _time_is_running_out(context):
+            return False
+        
+        batch = todo[:max_parallel]
+        for index, result in zip(batch, _run_parallel(lambda index: func(items[index], results[index]),
+                                                      batch, max_parallel)):
+            results[index] = result
+        if any(results[index]['status'] == 'pending' for index in batch):
+            return False
+
+
+def _bake(state, context):
+    """
+    等待本波的观察期结束，剩余执行时间不足时返回False
+    """
+    remaining = (state['bake_until'] or 0) - time.time()
+    if remaining <= 0:
+        return True
+    budget = _wait_budget(context, timeout=remaining)
+    time.sleep(budget)
+    return budget >= remaining
+
+
+def _wait_within_budget(wait, resolver_client, association_id, context):
+    """
+    在剩余执行时间内等待关联变更完成
+    
+    返回True表示完成，False表示等满ASSOCIATION_WAIT_TIMEOUT仍未完成，None表示剩余时间不足，
+    需要保存进度下次调用继续等待
+    """
+    budget = _wait_budget(context)
+    if wait(resolver_client, association_id, timeout=budget):
+        return True
+    return None if budget < ASSOCIATION_WAIT_TIMEOUT else False
+
+
+def _switch_vpc(resolver_client, from_rule_id, to_rule_id, vpc_id, context=None, progress=None):
+    """
+    把单个VPC从from_rule切换到to_rule，先等待解绑完成再绑定
+    
+    结果中记录切换前是否已关联两条规则，以及本次实际解绑/绑定了哪条规则，回滚时只撤销
+    本次切换做过的变更。剩余时间不足时返回status为pending的进度，下次调用以progress传入继续
+    """
+    result = dict(progress) if progress else {
+        'vpc_id': vpc_id,
+        'status': 'pending',
+        'had_from_rule': None,
+        'had_to_rule': None,
+        'disassociated_from_rule': False,
+        'associated_to_rule': None
+    }
+    
+    def finish(**fields):
+        changes = {key: result[key] for key in
+                   ('had_from_rule', 'had_to_rule', 'disassociated_from_rule', 'associated_to_rule')}
+        return {'vpc_id': vpc_id, **fields, **changes}
+    
+    try:
+        if result['had_from_rule'] is None:
+            existing_from = find_rule_association(resolver_client, from_rule_id, vpc_id)
+            existing_to = find_rule_association(resolver_client, to_rule_id, vpc_id)
+            result['had_from_rule'] = existing_from is not None
+            result['had_to_rule'] = existing_to is not None
+            result['from_association_id'] = existing_from['Id'] if existing_from else None
+            result['association_id'] = existing_to['Id'] if existing_to else None
+        
+        if result['had_from_rule'] and not result['disassociated_from_rule']:
+            disassociate_resolver_rule(resolver_client, from_rule_id, vpc_id,
+                                       association_id=result['from_association_id'])
+            result['disassociated_from_rule'] = True
+        
+        if result['disassociated_from_rule'] and not result.get('from_rule_settled'):
+            settled = _wait_within_budget(wait_for_disassociation, resolver_client,
+                                          result['from_association_id'], context)
+            if settled is None:
+                return result
+            if not settled:
+                return finish(status='failed', message=f'解绑 {from_rule_id} 未完成')
+            result['from_rule_settled'] = True
+        
+        if not result['association_id']:
+            result['association_id'] = associate_resolver_rule(resolver_client, to_rule_id, vpc_id,
+                                                               skip_lookup=True).get('association_id')
+            result['associated_to_rule'] = result['association_id']
+        
+        if result['association_id']:
+            ready = _wait_within_budget(wait_for_association, resolver_client, result['association_id'], context)
+            if ready is None:
+                return result
+            if not ready:
+                return finish(status='failed', message=f'绑定 {to_rule_id} 未生效')
+        
+        return finish(status='switched', association_id=result['association_id'])
+    
+    except ClientError as e:
+        return finish(**_failure_result(e))
+
+
+def _restore_vpc(resolver_client, from_rule_id, to_rule_id, switch_result, context=None, progress=None):
+    """
+    撤销_switch_vpc对单个VPC做过的变更：解绑本次新绑定的to_rule，重新绑定本次解绑的from_rule
+    
+    切换前就已存在或本就不存在的关联保持原样。剩余时间不足时与_switch_vpc一样返回pending进度
+    """
+    vpc_id = switch_result['vpc_id']
+    result = dict(progress) if progress else {'vpc_id': vpc_id, 'status': 'pending'}
+    try:
+        association_id = switch_result.get('associated_to_rule')
+        if association_id:
+            if not result.get('to_rule_disassociated'):
+                disassociate_resolver_rule(resolver_client, to_rule_id, vpc_id, association_id=association_id)
+                result['to_rule_disassociated'] = True
+            if not result.get('to_rule_settled'):
+                settled = _wait_within_budget(wait_for_disassociation, resolver_client, association_id, context)
+                if settled is None:
+                    return result
+                if not settled:
+                    return {'vpc_id': vpc_id, 'status': 'failed', 'message': f'解绑 {to_rule_id} 未完成'}
+                result['to_rule_settled'] = True
+        
+        if switch_result.get('disassociated_from_rule'):
+            if not result.get('from_rule_associated'):
+                result['restored_association_id'] = associate_resolver_rule(
+                    resolver_client, from_rule_id, vpc_id).get('association_id')
+                result['from_rule_associated'] = True
+            if result['restored_association_id']:
+                ready = _wait_within_budget(wait_for_association, resolver_client,
+                                            result['restored_association_id'], context)
+                if ready is None:
+                    return result
+                if not ready:
+                    return {'vpc_id': vpc_id, 'status': 'failed', 'message': f'绑定 {from_rule_id} 未生效'}
+        
+        if not association_id and not switch_result.get('disassociated_from_rule'):
+            return {'vpc_id': vpc_id, 'status': 'unchanged'}
+        return {'vpc_id': vpc_id, 'status': 'restored'}
+    
+    except ClientError as e:
+        return {'vpc_id': vpc_id, **_failure_result(e)}
+
+
+def _run_parallel(func, items, max_parallel):
+    """
+    以最多max_parallel个线程并发执行func，按输入顺序返回结果
+    """
+    if not items:
+        return []
+    with _ProfiledThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(items)))) as executor:
+        return list(executor.map(func, items))
+
+
+def _wave_is_healthy(results, health_alarm_names, cloudwatch_client):
+    """
+    检查一波切换是否健康：所有VPC切换成功，且指定的CloudWatch告警（指标告警或复合告警）
+    都存在并且不处于ALARM状态
+    """
+    failed = [result['vpc_id'] for result in results if result['status'] != 'switched']
+    if failed:
+        return False, f"切换失败的VPC: {failed}"
+    
+    if health_alarm_names:
+        alarms = cloudwatch_client.describe_alarms(
+            AlarmNames=health_alarm_names,
+            AlarmTypes=['MetricAlarm', 'CompositeAlarm']
+        )
+        alarms = alarms.get('MetricAlarms', []) + alarms.get('CompositeAlarms', [])
+        # 告警名称写错或告警已被删除时无法判断健康状态，按不健康处理
+        missing = sorted(set(health_alarm_names) - {alarm['AlarmName'] for alarm in alarms})
+        if missing:
+            return False, f"告警不存在: {missing}"
+        firing = [alarm['AlarmName'] for alarm in alarms if alarm['StateValue'] == 'ALARM']
+        if firing:
+            return False, f"告警触发: {firing}"
+    
+    return True, None
+
+
+def _rollout_response(event, context):
+    """
+    处理分波次切换请求，rollout.continuation_token存在时从检查点继续
+    """
+    rollout = event['rollout']
+    if rollout.get('continuation_token'):
+        state = decode_continuation_token(rollout['continuation_token'])
+        if state.get('mode') != 'rollout':
+            raise ValueError("continuation_token不是分波次切换的检查点")
+        logger.info(f"从检查点恢复分波次切换: 阶段 {state['phase']}, "
+                    f"第 {state['wave_index'] + 1}/{len(state['waves'])} 波")
+    else:
+        from_rule_id = rollout.get('from_rule_id')
+        to_rule_id = rollout.get('to_rule_id')
+        vpc_ids = rollout.get('vpc_ids')
+        account_id = event.get('account_id')
+        
+        if not all([from_rule_id, to_rule_id]):
+            raise ValueError("rollout缺少必需参数: from_rule_id, to_rule_id")
+        if not vpc_ids or not isinstance(vpc_ids, list):
+            raise ValueError("rollout.vpc_ids必须是非空列表")
+        if account_id is not None and not _is_valid_account_id(account_id):
+            raise ValueError(f"无效的account_id: {account_id}")
+        
+        state = new_rollout_state(
+            from_rule_id,
+            to_rule_id,
+            vpc_ids,
+            event.get('region', 'us-west-2'),
+            account_id=account_id,
+            canary_percent=rollout.get('canary_percent', 10),
+            growth_factor=rollout.get('growth_factor', 2),
+            max_parallel=rollout.get('max_parallel', 10),
+            bake_seconds=rollout.get('bake_seconds', 0),
+            health_alarm_names=rollout.get('health_alarm_names')
+        )
+        logger.info(f"开始分波次切换: {from_rule_id} -> {to_rule_id}, "
+                    f"共 {len(vpc_ids)} 个VPC, 波次 {state['waves']}")
+    
+    resolver_client = get_resolver_client(state['region'], state['account_id'])
+    cloudwatch_client = None
+    if state['health_alarm_names']:
+        cloudwatch_client = boto3.client('cloudwatch', region_name=state['region'], config=RETRY_CONFIG)
+    
+    if not rollout_rule_switch(resolver_client, state, context, cloudwatch_client):
+        logger.info(f"剩余时间不足，保存分波次切换检查点: 阶段 {state['phase']}, "
+                    f"第 {state['wave_index'] + 1}/{len(state['waves'])} 波")
+        return {
+            'statusCode': 202,
+            'body': json.dumps({
+                'message': '分波次切换未完成，请携带rollout.continuation_token再次调用',
+                'phase': state['phase'],
+                'wave': state['wave_index'] + 1,
+                'total_waves': len(state['waves']),
+                'continuation_token': encode_continuation_token(state)
+            }, ensure_ascii=False)
+        }
+    
+    report = state['report']
+    completed = report['status'] == 'completed'
+    return {
+        'statusCode': 200 if completed else 500,
+        'body': json.dumps({
+            'message': '分波次切换成功完成' if completed else '切换中止并已回滚',
+            'result': report
+        }, ensure_ascii=False)
+    }
+
+
+# ==================== SQS / EventBridge 批量消息 ====================
+
+def process_records(event, context):
+    """
+    处理SQS批量消息，返回batchItemFailures（需要在事件源映射中启用ReportBatchItemFailures）
+    
+    同一规则与VPC的多条消息只执行最后一条（最终期望状态），被合并的消息与其共享结果，
+    位置取其中最早的一条。同一VPC的操作串行执行，同域名规则先解绑再绑定，其余按到达顺序；
+    不同VPC并发执行。
+    """
+    records = event['Records']
+    failed_message_ids = []
+    latest = {}
+    held_keys = set()
+    
+    for position, record in enumerate(records):
+        message_id = record.get('messageId')
+        try:
+            operation = _parse_record(record)
+        except ValueError as e:
+            logger.error(f"无法解析消息 {message_id}: {str(e)}")
+            failed_message_ids.append(message_id)
+            continue
+        
+        # 已成功处理过的消息（重复投递或带相同幂等键）直接确认；幂等键被不同的请求复用时
+        # 按失败处理，多次重试后进入死信队列
+        try:
+            cached = IDEMPOTENCY_CACHE.get(operation['idempotency_key'], operation['fingerprint'])
+        except ValueError as e:
+            logger.error(f"消息 {message_id}: {str(e)}")
+            failed_message_ids.append(message_id)
+            continue
+        if cached is not None:
+            logger.info(f"消息 {message_id} 的幂等键已处理过，跳过")
+            continue
+        # 同一幂等键正在被其他调用处理时稍后重新投递；本批次中已占用的键不再重复占用
+        if operation['idempotency_key'] not in held_keys:
+            if not IDEMPOTENCY_CACHE.acquire(operation['idempotency_key'], operation['fingerprint']):
+                logger.warning(f"消息 {message_id} 的幂等键正在被其他请求处理，稍后重试")
+                failed_message_ids.append(message_id)
+                continue
+            held_keys.add(operation['idempotency_key'])
+        
+        key = (operation['account_id'], operation['region'], operation['resolver_rule_id'], operation['vpc_id'])
+        superseded = latest.pop(key, None)
+        operation['message_ids'] = (superseded['message_ids'] if superseded else []) + [message_id]
+        operation['idempotency_keys'] = (superseded['idempotency_keys'] if superseded else []) + \
+            [(operation['idempotency_key'], operation['fingerprint'])]
+        # 合并后的操作保留最早一条消息的位置，避免排到同一VPC中依赖它的操作之后
+        operation['position'] = superseded['position'] if superseded else position
+        latest[key] = operation
+    
+    groups = {}
+    for operation in sorted(latest.values(), key=lambda item: item['position']):
+        group_key = (operation['account_id'], operation['region'], operation['vpc_id'])
+        groups.setdefault(group_key, []).append(operation)
+    
+    logger.info(f"收到 {len(records)} 条消息，去重后 {len(latest)} 个操作，分为 {len(groups)} 个VPC分组")
+    
+    if groups:
+        with _ProfiledThreadPoolExecutor(max_workers=min(MAX_RECORD_WORKERS, len(groups))) as executor:
+            for group_failures in executor.map(_process_vpc_group, groups.values()):
+                failed_message_ids.extend(group_failures)
+    
+    if failed_message_ids:
+        logger.error(f"{len(failed_message_ids)}/{len(records)} 条消息处理失败，将被重新投递")
+    
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
+    }
+
+
+def _parse_record(record):
+    """
+    把SQS消息解析为操作，消息格式无效时抛出ValueError
+    """
+    try:
+        payload = json.loads(record['body'])
+    except (KeyError, TypeError, json.JSONDecodeError):
+        raise ValueError("消息body不是有效的JSON")
+    
+    # EventBridge规则投递到SQS时，操作放在detail中
+    if isinstance(payload, dict) and isinstance(payload.get('detail'), dict):
+        payload = payload['detail']
+    if not isinstance(payload, dict):
+        raise ValueError("消息body必须是JSON对象")
+    
+    action = payload.get('action')
+    resolver_rule_id = payload.get('resolver_rule_id')
+    vpc_id = payload.get('vpc_id')
+    account_id = payload.get('account_id')
+    
+    if not all([action, resolver_rule_id, vpc_id]):
+        raise ValueError("缺少必需参数: action, resolver_rule_id, vpc_id")
+    if action not in ['associate', 'disassociate']:
+        raise ValueError("action必须是 'associate' 或 'disassociate'")
+    if account_id is not None and not _is_valid_account_id(account_id):
+        raise ValueError(f"无效的account_id: {account_id}")
+    
+    return {
+        'action': action,
+        'resolver_rule_id': resolver_rule_id,
+        'vpc_id': vpc_id,
+        'account_id': account_id,
+        'region': payload.get('region', 'us-west-2'),
+        # 未指定幂等键时使用messageId，重复投递的同一条消息不会再次执行
+        'idempotency_key': payload.get('idempotency_key') or f"sqs:{record.get('messageId')}",
+        'fingerprint': _request_fingerprint(payload)
+    }
+
+
+def _process_vpc_group(operations):
+    """
+    串行执行同一VPC的操作，返回失败的消息ID
+    
+    某个操作失败后，同一VPC中后续的操作不再执行，与其一起重新投递以保持顺序
+    """
+    first = operations[0]
+    try:
+        resolver_client = get_resolver_client(first['region'], first['account_id'])
+    except (ClientError, BotoCoreError) as e:
+        logger.error(f"无法获取账户 {first['account_id']} 的凭证: {str(e)}")
+        return _release_operations(operations)
+    
+    operations = _order_vpc_group(resolver_client, operations)
+    for index, operation in enumerate(operations):
+        try:
+            if operation['action'] == 'associate':
+                result = associate_resolver_rule(resolver_client, operation['resolver_rule_id'], operation['vpc_id'])
+            else:
+                result = disassociate_resolver_rule(resolver_client, operation['resolver_rule_id'], operation['vpc_id'])
+                # 后面还有该VPC的操作时，等待解绑真正完成
+                has_more = index < len(operations) - 1
+                if has_more and result.get('association_id') and \
+                        not wait_for_disassociation(resolver_client, result['association_id']):
+                    raise RuntimeError(f"解绑 {operation['resolver_rule_id']} 未在超时时间内完成")
+            
+            response = _operation_response(operation['action'], result)
+            for idempotency_key, fingerprint in operation['idempotency_keys']:
+                IDEMPOTENCY_CACHE.put(idempotency_key, response, fingerprint)
+        except Exception as e:
+            logger.error(f"VPC {operation['vpc_id']} 的操作 {operation['action']} {operation['resolver_rule_id']} "
+                         f"失败: {str(e)}")
+            return _release_operations(operations[index:])
+    
+    return []
+
+
+def _release_operations(operations):
+    """
+    释放未完成操作占用的幂等键，返回需要重新投递的消息ID
+    """
+    for operation in operations:
+        for idempotency_key, _ in operation['idempotency_keys']:
+            IDEMPOTENCY_CACHE.release(idempotency_key)
+    return [message_id for operation in operations for message_id in operation['message_ids']]
+
+
+def _order_vpc_group(resolver_client, operations):
+    """
+    确定同一VPC中操作的执行顺序：同域名规则的解绑排在绑定之前，其余保持到达顺序
+    
+    只有分组中同时存在解绑和绑定时才需要查询规则域名
+    """
+    if len({operation['action'] for operation in operations}) < 2:
+        return operations
+    
+    domains = _resolve_rule_domains(resolver_client, {operation['resolver_rule_id'] for operation in operations},
+                                    MAX_RECORD_WORKERS)
+    dependencies, dependents = build_dependency_graph(operations, domains)
+    
+    # 依赖只从解绑指向绑定，不会成环；就绪的操作中总是先执行到达最早的
+    remaining = [len(deps) for deps in dependencies]
+    ready = [index for index, count in enumerate(remaining) if count == 0]
+    ordered = []
+    while ready:
+        index = heapq.heappop(ready)
+        ordered.append(operations[index])
+        for dependent in dependents[index]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                heapq.heappush(ready, dependent)
+    return ordered
+
+
+# ==================== 幂等键结果缓存 ====================
+
+class FileIdempotencyStore:
+    """
+    基于本地文件的持久化后端，每个幂等键一个JSON文件
+    
+    用于本地测试，或在同一容器内跨冷启动保留结果（/tmp在容器回收前一直保留）
+    """
+    
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+    
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return item if item.get('expires_at', 0) > time.time() else None
+    
+    def put(self, key, response, expires_at, fingerprint=None):
+        self._write(key, {'response': response, 'expires_at': expires_at, 'fingerprint': fingerprint})
+    
+    def acquire(self, key, expires_at, fingerprint=None):
+        item = {'status': 'INPROGRESS', 'expires_at': expires_at, 'fingerprint': fingerprint}
+        try:
+            fd = os.open(self._path(key), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            # 已过期的记录（包括中断请求留下的占用）可以被覆盖
+            if self.get(key) is not None:
+                return False
+            self._write(key, item)
+            return True
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(item, f, ensure_ascii=False)
+        return True
+    
+    def release(self, key):
+        item = self.get(key)
+        if item is not None and item.get('status') == 'INPROGRESS':
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+    
+    def _write(self, key, item):
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(item, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+    
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+
+class DynamoDBIdempotencyStore:
+    """
+    基于DynamoDB的持久化后端，表的分区键为idempotency_key（字符串），
+    建议在expires_at属性上启用TTL自动清理过期记录
+    """
+    
+    def __init__(self, table_name, dynamodb_client=None):
+        self._table_name = table_name
+        self._client = dynamodb_client or boto3.client('dynamodb', config=RETRY_CONFIG)
+    
+    def get(self, key):
+        item = self._client.get_item(
+            TableName=self._table_name,
+            Key={'idempotency_key': {'S': key}},
+            ConsistentRead=True
+        ).get('Item')
+        if not item:
+            return None
+        
+        # TTL删除有延迟，读取时再检查一次是否过期
+        expires_at = float(item['expires_at']['N'])
+        if expires_at <= time.time():
+            return None
+        return {
+            'response': json.loads(item['response']['S']) if 'response' in item else None,
+            'status': item.get('status', {}).get('S'),
+            'expires_at': expires_at,
+            'fingerprint': item.get('fingerprint', {}).get('S')
+        }
+    
+    def put(self, key, response, expires_at, fingerprint=None):
+        item = {
+            'idempotency_key': {'S': key},
+            'response': {'S': json.dumps(response, ensure_ascii=False)},
+            'expires_at': {'N': str(int(expires_at))}
+        }
+        if fingerprint:
+            item['fingerprint'] = {'S': fingerprint}
+        self._client.put_item(TableName=self._table_name, Item=item)
+    
+    def acquire(self, key, expires_at, fingerprint=None):
+        item = {
+            'idempotency_key': {'S': key},
+            'status': {'S': 'INPROGRESS'},
+            'expires_at': {'N': str(int(expires_at))}
+        }
+        if fingerprint:
+            item['fingerprint'] = {'S': fingerprint}
+        try:
+            # 只有键不存在，或已有记录（结果或中断请求留下的占用）已过期时才能写入
+            self._client.put_item(
+                TableName=self._table_name,
+                Item=item,
+                ConditionExpression='attribute_not_exists(idempotency_key) OR expires_at < :now',
+                ExpressionAttributeValues={':now': {'N': str(int(time.time()))}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+    
+    def release(self, key):
+        try:
+            # 只删除占用记录，不删除已保存的结果
+            self._client.delete_item(
+                TableName=self._table_name,
+                Key={'idempotency_key': {'S': key}},
+                ConditionExpression='#status = :in_progress',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':in_progress': {'S': 'INPROGRESS'}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+
+class IdempotencyCache:
+    """
+    幂等键结果的两级TTL缓存：容器内存一级，可插拔的持久化后端（get/put）二级
+    
+    每条结果同时保存请求内容的摘要，同一个幂等键被用于不同的请求时拒绝而不是返回旧结果。
+    执行前通过acquire占用幂等键（后端为acquire/release），并发的重复请求不会同时执行。
+    后端不可用时只记录告警并按未命中处理，不影响正常请求
+    """
+    
+    def __init__(self, backend=None, ttl_seconds=IDEMPOTENCY_TTL_SECONDS, namespace='vpc-association',
+                 lock_seconds=IDEMPOTENCY_LOCK_SECONDS):
+        self._backend = backend
+        self._ttl_seconds = ttl_seconds
+        self._namespace = namespace
+        self._lock_seconds = lock_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._in_progress = {}
+    
+    def get(self, key, fingerprint=None):
+        """
+        返回幂等键对应的结果，不存在或已过期时返回None
+        
+        保存的请求摘要与fingerprint不一致时抛出ValueError
+        """
+        original_key = key
+        key = f"{self._namespace}:{key}"
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._check_fingerprint(original_key, entry[2], fingerprint)
+                    return entry[1]
+                del self._entries[key]
+        
+        if self._backend is None:
+            return None
+        try:
+            item = self._backend.get(key)
+        except Exception as e:
+            logger.warning(f"读取幂等缓存失败: {str(e)}")
+            return None
+        if item is None:
+            return None
+        
+        self._check_fingerprint(original_key, item.get('fingerprint'), fingerprint)
+        # 其他请求正在执行，尚无结果
+        if item.get('status') == 'INPROGRESS':
+            return None
+        with self._lock:
+            self._entries[key] = (item['expires_at'], item['response'], item.get('fingerprint'))
+        return item['response']
+    
+    def acquire(self, key, fingerprint=None):
+        """
+        执行请求前占用幂等键，同一个键正在被其他请求处理时返回False
+        
+        有持久化后端时通过条件写入占用，跨容器生效；占用在lock_seconds后过期，执行中途
+        被中断的请求不会永久占用幂等键
+        """
+        key = f"{self._namespace}:{key}"
+        now = time.time()
+        expires_at = now + self._lock_seconds
+        with self._lock:
+            if self._in_progress.get(key, 0) > now:
+                return False
+            self._in_progress[key] = expires_at
+        
+        if self._backend is None:
+            return True
+        try:
+            acquired = self._backend.acquire(key, expires_at, fingerprint)
+        except Exception as e:
+            logger.warning(f"占用幂等键失败: {str(e)}")
+            return True
+        if not acquired:
+            with self._lock:
+                self._in_progress.pop(key, None)
+        return acquired
+    
+    def release(self, key):
+        """
+        释放acquire占用的幂等键，请求失败或未完成时调用，允许之后重试
+        """
+        key = f"{self._namespace}:{key}"
+        with self._lock:
+            self._in_progress.pop(key, None)
+        if self._backend is not None:
+            try:
+                self._backend.release(key)
+            except Exception as e:
+                logger.warning(f"释放幂等键失败: {str(e)}")
+    
+    def put(self, key, response, fingerprint=None):
+        """
+        保存幂等键对应的结果和请求摘要
+        """
+        key = f"{self._namespace}:{key}"
+        expires_at = time.time() + self._ttl_seconds
+        with self._lock:
+            self._entries[key] = (expires_at, response, fingerprint)
+            self._in_progress.pop(key, None)
+            # 顺带清理过期的内存条目，避免长时间运行的容器无限增长
+            if len(self._entries) > 10000:
+                now = time.time()
+                for expired in [k for k, entry in self._entries.items() if entry[0] <= now]:
+                    del self._entries[expired]
+        
+        if self._backend is not None:
+            try:
+                self._backend.put(key, response, expires_at, fingerprint)
+            except Exception as e:
+                logger.warning(f"写入幂等缓存失败: {str(e)}")
+    
+    @staticmethod
+    def _check_fingerprint(key, stored, fingerprint):
+        # 旧版本保存的结果没有摘要，不做比较
+        if stored and fingerprint and stored != fingerprint:
+            raise ValueError(f"幂等键 {key} 已被用于不同的请求")
+
+
+def _request_fingerprint(payload):
+    """
+    计算请求内容的摘要，幂等键本身和debug_profile不参与计算
+    
+    单个操作只取决定其效果的字段，并补齐默认region，因此省略默认值或附带无关字段的重试
+    （包括同一操作的SQS消息和直接调用）得到相同的摘要
+    """
+    is_batch = any(key in payload for key in ('operations', 'continuation_token', 'rollout', 'schedule'))
+    if payload.get('action') and not is_batch:
+        request = {key: payload.get(key) for key in ('action', 'resolver_rule_id', 'vpc_id', 'account_id')}
+    else:
+        request = {key: value for key, value in payload.items() if key not in ('idempotency_key', 'debug_profile')}
+    request['region'] = payload.get('region', 'us-west-2')
+    raw = json.dumps(request, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _default_idempotency_backend():
+    """
+    根据环境变量选择持久化后端：IDEMPOTENCY_TABLE为DynamoDB表，IDEMPOTENCY_DIR为本地目录
+    """
+    if os.environ.get('IDEMPOTENCY_TABLE'):
+        return DynamoDBIdempotencyStore(os.environ['IDEMPOTENCY_TABLE'])
+    if os.environ.get('IDEMPOTENCY_DIR'):
+        return FileIdempotencyStore(os.environ['IDEMPOTENCY_DIR'])
+    return None
+
+
+# 容器生命周期内共享的幂等缓存，测试时可替换为使用其他后端的实例
+IDEMPOTENCY_CACHE = IdempotencyCache(_default_idempotency_backend())
+
+# 保存过大检查点状态的持久化后端，与幂等缓存使用相同的配置，未配置时为None
+CHECKPOINT_STORE = _default_idempotency_backend()
+
+
+# ==================== 性能分析 ====================
+
+class _WorkerProfiles:
+    """
+    收集一次性能分析期间各工作线程任务的cProfile结果
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profilers = []
+    
+    def run(self, func, *args, **kwargs):
+        import cProfile
+        
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12起cProfile基于sys.monitoring，主线程的profiler已经覆盖所有线程
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with self._lock:
+                self.profilers.append(profiler)
+
+
+# 正在进行性能分析时为_WorkerProfiles实例，否则为None
+_WORKER_PROFILES = None
+
+
+class _ProfiledThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    性能分析期间在工作线程中为每个任务启用cProfile，未开启分析时与ThreadPoolExecutor相同
+    """
+    
+    def submit(self, fn, /, *args, **kwargs):
+        worker_profiles = _WORKER_PROFILES
+        if worker_profiles is None:
+            return super().submit(fn, *args, **kwargs)
+        return super().submit(worker_profiles.run, fn, *args, **kwargs)
+
+
+def _run_profiled(func, event, context):
+    """
+    在cProfile和tracemalloc下执行一次调用
+    
+    日志中输出按累计耗时排序的前PROFILE_TOP_N个函数和分配内存最多的代码行，完整的
+    profile写入PROFILE_DIR，可用pstats或snakeviz查看。工作线程中的任务（AWS调用、
+    重试等待、客户端创建）单独采集后与主线程的结果合并。
+    """
+    import cProfile
+    import pstats
+    import tracemalloc
+    global _WORKER_PROFILES
+    
+    request_id = getattr(context, 'aws_request_id', None) or str(int(time.time() * 1000))
+    profiler = cProfile.Profile()
+    worker_profiles = _WORKER_PROFILES = _WorkerProfiles()
+    tracemalloc.start()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        return func(event, context)
+    finally:
+        profiler.disable()
+        _WORKER_PROFILES = None
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        
+        stats = pstats.Stats(profiler)
+        for worker_profiler in worker_profiles.profilers:
+            stats.add(worker_profiler)
+        
+        try:
+            path = os.path.join(PROFILE_DIR, f"profile-{request_id}.prof")
+            stats.dump_stats(path)
+        except OSError as e:
+            path = None
+            logger.warning(f"写入profile文件失败: {str(e)}")
+        
+        logger.info(_profile_summary(stats, len(worker_profiles.profilers), snapshot, elapsed_ms, peak, path))
+
+
+def _profile_summary(stats, worker_tasks, snapshot, elapsed_ms, peak_bytes, path):
+    """
+    生成紧凑的性能分析摘要
+    
+    合并了工作线程的结果后，累计耗时是各线程之和，可能超过调用的实际耗时
+    """
+    top_functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP_N]
+    
+    lines = [f"性能分析: 耗时 {elapsed_ms:.1f}ms, 内存峰值 {peak_bytes / 1024:.1f}KB, "
+             f"合并工作线程任务 {worker_tasks} 个, profile文件 {path}",
+             "累计耗时最多的函数 (累计ms / 自身ms / 调用次数):"]
+    for (filename, lineno, function), (_, calls, self_time, cumulative, _) in top_functions:
+        lines.append(f"  {cumulative * 1000:9.1f} {self_time * 1000:9.1f} {calls:7d}  "
+                     f"{function} ({os.path.basename(filename)}:{lineno})")
+    
+    lines.append("分配内存最多的代码行:")
+    for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]:
+        frame = stat.traceback[0]
+        lines.append(f"  {stat.size / 1024:9.1f}KB {stat.count:7d}  {os.path.basename(frame.filename)}:{frame.lineno}")
+    
+    return "\n".join(lines)
+
+
+# ==================== 域名冲突感知的并发调度 ====================
+
+def schedule_operations(resolver_client, operations, max_parallel=16, context=None):
+    """
+    按域名冲突构建依赖图并发执行绑定/解绑操作
+    
+    同域名的两条规则不能同时绑定同一个VPC，因此对每个(VPC, 域名)，所有解绑必须完成
+    （等待关联真正删除）后才能开始绑定；不同VPC或不同域名之间没有依赖。所有依赖已满足
+    的操作立即并发执行，总耗时接近依赖图的关键路径而不是所有操作之和。线程池只执行
+    绑定/解绑调用，解绑是否完成由调度循环每ASSOCIATION_POLL_INTERVAL秒统一轮询，
+    等待中的解绑不占用线程。依赖的解绑失败时，后续绑定不再执行并记为skipped。
+    
+    剩余执行时间低于检查点阈值后不再提交新的操作，等待解绑的时间也不超过剩余执行时间，
+    未执行的操作同样记为skipped。
+    """
+    _validate_schedule_operations(operations)
+    
+    domains = _resolve_rule_domains(resolver_client, {op['resolver_rule_id'] for op in operations}, max_parallel)
+    dependencies, dependents = build_dependency_graph(operations, domains)
+    logger.info(f"调度 {len(operations)} 个操作，其中 {sum(1 for deps in dependencies if deps)} 个需要等待解绑完成")
+    
+    results = [None] * len(operations)
+    remaining = [len(deps) for deps in dependencies]
+    start = time.time()
+    
+    def run(index):
+        # 工作线程只执行绑定/解绑调用，等待解绑完成由调度循环轮询，不占用线程
+        operation = operations[index]
+        try:
+            if operation['action'] == 'associate':
+                return associate_resolver_rule(resolver_client, operation['resolver_rule_id'], operation['vpc_id'])
+            return disassociate_resolver_rule(resolver_client, operation['resolver_rule_id'], operation['vpc_id'])
+        except ClientError as e:
+            return _failure_result(e)
+    
+    def skip(index, reason):
+        # 依赖失败，递归跳过所有后续操作
+        results[index] = {'status': 'skipped', 'message': reason}
+        for dependent in dependents[index]:
+            if results[dependent] is None:
+                skip(dependent, reason)
+    
+    def submit(index):
+        if _time_is_running_out(context):
+            skip(index, '剩余执行时间不足，未执行')
+        else:
+            running[executor.submit(run, index)] = index
+    
+    def finish(index, result):
+        results[index] = result
+        failed = result['status'] == 'failed'
+        for dependent in dependents[index]:
+            if results[dependent] is not None:
+                continue
+            if failed:
+                operation = operations[index]
+                skip(dependent, f"依赖的解绑 {operation['resolver_rule_id']} / {operation['vpc_id']} 失败")
+                continue
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                submit(dependent)
+    
+    # 已提交解绑、有绑定在等待其真正删除的操作: index -> (association_id, deadline, result, 截止时间是否受剩余执行时间限制)
+    settling = {}
+    next_poll = 0
+    running = {}
+    
+    with _ProfiledThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(operations)))) as executor:
+        for index, count in enumerate(remaining):
+            if count == 0:
+                submit(index)
+        while running or settling:
+            timeout = max(0, next_poll - time.time()) if settling else None
+            if running:
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                done = ()
+                time.sleep(timeout)
+            
+            for future in done:
+                index = running.pop(future)
+                result = future.result()
+                if dependents[index] and result['status'] == 'disassociated' and result.get('association_id'):
+                    budget = _wait_budget(context)
+                    settling[index] = (result['association_id'], time.time() + budget, result,
+                                       budget < ASSOCIATION_WAIT_TIMEOUT)
+                else:
+                    finish(index, result)
+            
+            if settling and time.time() >= next_poll:
+                for index, (association_id, deadline, result, limited) in list(settling.items()):
+                    try:
+                        association = _get_association_if_exists(resolver_client, association_id)
+                    except ClientError as e:
+                        del settling[index]
+                        finish(index, _failure_result(e))
+                        continue
+                    if association is None:
+                        del settling[index]
+                        finish(index, result)
+                    elif time.time() >= deadline and limited:
+                        # 解绑本身已成功，只是来不及等到删除完成，依赖它的绑定不再执行
+                        logger.warning(f"剩余执行时间不足，未等到关联 {association_id} 删除完成")
+                        del settling[index]
+                        results[index] = result
+                        for dependent in dependents[index]:
+                            if results[dependent] is None:
+                                skip(dependent, '剩余执行时间不足，未等到解绑完成')
+                    elif time.time() >= deadline:
+                        logger.error(f"等待关联 {association_id} 删除超时，当前状态: {association['Status']}")
+                        del settling[index]
+                        finish(index, {'status': 'failed', 'message': '解绑未在超时时间内完成'})
+                next_poll = time.time() + ASSOCIATION_POLL_INTERVAL
+    
+    elapsed = time.time() - start
+    logger.info(f"调度完成，耗时 {elapsed:.1f} 秒")
+    return [
+        {
+            'action': operation['action'],
+            'resolver_rule_id': operation['resolver_rule_id'],
+            'vpc_id': operation['vpc_id'],
+            'domain_name': domains.get(operation['resolver_rule_id']),
+            **result
+        }
+        for operation, result in zip(operations, results)
+    ]
+
+
+def _validate_schedule_operations(operations):
+    """
+    校验调度的操作列表，参数无效时抛出ValueError
+    """
+    if not operations or not isinstance(operations, list):
+        raise ValueError("operations必须是非空列表")
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            raise ValueError(f"第 {index} 个操作必须是JSON对象")
+        if not all([operation.get('action'), operation.get('resolver_rule_id'), operation.get('vpc_id')]):
+            raise ValueError(f"第 {index} 个操作缺少必需参数: action, resolver_rule_id, vpc_id")
+        if operation['action'] not in ['associate', 'disassociate']:
+            raise ValueError(f"第 {index} 个操作的action必须是 'associate' 或 'disassociate'")
+
+
+def build_dependency_graph(operations, domains):
+    """
+    构建依赖图，返回(dependencies, dependents)：
+    dependencies[i]为操作i需要等待的操作，dependents[i]为等待操作i的操作
+    
+    同一VPC中的绑定依赖于同域名规则的解绑；规则域名未知时保守处理，
+    视为与该VPC中所有域名冲突
+    """
+    dependencies = [set() for _ in operations]
+    dependents = [set() for _ in operations]
+    
+    disassociations_by_vpc = {}
+    for index, operation in enumerate(operations):
+        if operation['action'] == 'disassociate':
+            disassociations_by_vpc.setdefault(operation['vpc_id'], []).append(index)
+    
+    for index, operation in enumerate(operations):
+        if operation['action'] != 'associate':
+            continue
+        domain = domains.get(operation['resolver_rule_id'])
+        for other in disassociations_by_vpc.get(operation['vpc_id'], []):
+            other_domain = domains.get(operations[other]['resolver_rule_id'])
+            if domain is None or other_domain is None or domain == other_domain:
+                dependencies[index].add(other)
+                dependents[other].add(index)
+    
+    return dependencies, dependents
+
+
+def _resolve_rule_domains(resolver_client, resolver_rule_ids, max_parallel):
+    """
+    并发查询规则的域名（统一为小写、去掉末尾的点），查询失败的规则不出现在结果中
+    """
+    def fetch(resolver_rule_id):
+        rule = get_resolver_rule_info(resolver_client, resolver_rule_id)
+        if rule is None or not rule.get('DomainName'):
+            logger.warning(f"无法获取规则 {resolver_rule_id} 的域名，按与所有域名冲突处理")
+            return resolver_rule_id, None
+        return resolver_rule_id, rule['DomainName'].lower().rstrip('.')
+    
+    rule_ids = sorted(resolver_rule_ids)
+    with _ProfiledThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(rule_ids)))) as executor:
+        return {rule_id: domain for rule_id, domain in executor.map(fetch, rule_ids) if domain is not None}
+
+
+def _schedule_response(event, context):
+    """
+    处理按域名冲突调度的请求
+    
+    操作可以各自指定account_id（默认使用event中的account_id），不同账户的操作分组，
+    各自使用该账户的凭证并发调度，结果按原顺序返回
+    """
+    schedule = event['schedule']
+    operations = schedule.get('operations')
+    # 执行任何分组前先校验全部操作，避免部分账户已经执行后才发现参数错误
+    _validate_schedule_operations(operations)
+    
+    groups = {}
+    for index, operation in enumerate(operations):
+        account_id = operation.get('account_id', event.get('account_id'))
+        if account_id is not None and not _is_valid_account_id(account_id):
+            raise ValueError(f"第 {index} 个操作的account_id无效: {account_id}")
+        groups.setdefault(account_id, []).append(index)
+    
+    region = event.get('region', 'us-west-2')
+    max_parallel = schedule.get('max_parallel', 16)
+    results = [None] * len(operations)
+    
+    def run_group(account_id, indexes):
+        group = [operations[index] for index in indexes]
+        try:
+            resolver_client = get_resolver_client(region, account_id)
+        except (ClientError, BotoCoreError) as e:
+            # 无法获取该账户的凭证，该账户下的操作全部记为失败
+            logger.error(f"无法获取账户 {account_id} 的凭证: {str(e)}")
+            group_results = [
+                {
+                    'action': operation['action'],
+                    'resolver_rule_id': operation['resolver_rule_id'],
+                    'vpc_id': operation['vpc_id'],
+                    **_failure_result(e)
+                }
+                for operation in group
+            ]
+        else:
+            group_results = schedule_operations(resolver_client, group, max_parallel=max_parallel, context=context)
+        for index, result in zip(indexes, group_results):
+            results[index] = {'account_id': account_id, **result}
+    
+    if len(groups) == 1:
+        for account_id, indexes in groups.items():
+            run_group(account_id, indexes)
+    else:
+        with _ProfiledThreadPoolExecutor(max_workers=min(MAX_ACCOUNT_WORKERS, len(groups))) as executor:
+            for future in [executor.submit(run_group, account_id, indexes) for account_id, indexes in groups.items()]:
+                future.result()
+    
+    failed = [result for result in results if result['status'] in ('failed', 'skipped')]
+    return {
+        'statusCode': 500 if failed else 200,
+        'body': json.dumps({
+            'message': '部分操作失败' if failed else '调度操作成功完成',
+            'total': len(results),
+            'failed': len(failed),
+            'results': results
+        }, ensure_ascii=False)
+    }
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+多账户凭证缓存演示：使用本地STS替身，不会调用任何AWS接口
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lambda_function import AssumedRoleCredentialCache
+
+ACCOUNT_IDS = ["111111111111", "222222222222", "333333333333"]
+
+
+class LocalSts:
+    """本地STS替身，只实现assume_role，并记录调用次数"""
+
+    def __init__(self, clock, duration_seconds=3600):
+        self.clock = clock
+        self.duration_seconds = duration_seconds
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def assume_role(self, RoleArn, RoleSessionName, DurationSeconds):
+        with self._lock:
+            self.calls.append(RoleArn)
+            serial = len(self.calls)
+        time.sleep(0.05)  # 模拟网络往返
+        return {
+            'Credentials': {
+                'AccessKeyId': f"ASIALOCAL{serial:08d}",
+                'SecretAccessKey': 'local-secret',
+                'SessionToken': 'local-token',
+                'Expiration': self.clock() + self.duration_seconds
+            }
+        }
+
+
+class FakeClock:
+    """可手动拨动的时钟"""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def print_separator(title):
+    """打印分隔符"""
+    print("\n" + "=" * 60)
+    print(f" {title}")
+    print("=" * 60)
+
+
+def main():
+    clock = FakeClock()
+    sts = LocalSts(clock)
+    cache = AssumedRoleCredentialCache(sts_client=sts, clock=clock)
+
+    print_separator("1. 多账户并发获取凭证")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        # 每个账户并发请求4次，STS只应被调用一次
+        list(executor.map(cache.get_credentials, ACCOUNT_IDS * 4))
+    print(f"请求次数: {len(ACCOUNT_IDS) * 4}, STS调用次数: {len(sts.calls)}")
+
+    print_separator("2. 凭证有效期内直接命中缓存")
+    clock.now += 1800
+    for account_id in ACCOUNT_IDS:
+        cache.get_credentials(account_id)
+    print(f"30分钟后, STS调用次数: {len(sts.calls)}")
+
+    print_separator("3. 临近过期时后台刷新")
+    clock.now += 1000  # 距离过期约13分钟，进入后台刷新窗口
+    before = cache.get_credentials(ACCOUNT_IDS[0])['access_key_id']
+    time.sleep(0.2)  # 等待后台刷新完成
+    after = cache.get_credentials(ACCOUNT_IDS[0])['access_key_id']
+    print(f"返回的仍是旧凭证: {before}, 后台刷新后: {after}")
+    print(f"STS调用次数: {len(sts.calls)}")
+
+    print_separator("4. 已过期的凭证同步刷新")
+    clock.now += 3600
+    credentials = cache.get_credentials(ACCOUNT_IDS[1])
+    print(f"新凭证: {credentials['access_key_id']}, STS调用次数: {len(sts.calls)}")
+
+
+if __name__ == "__main__":
+    main()